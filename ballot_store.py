@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	compact invites/results storage
+
+	a dict of {full voter ID: invite} plus a dict of {secret: answer} costs a
+	few hundred bytes per voter (dict slots, bytes and int objects) ; for a
+	million voters this no longer fits on a RaspberryPi-type host. here, every
+	voter gets a slot in a handful of flat arrays instead :
+
+	- digests	fixed-size blake2b digest of the full voter ID, sorted (slot order)
+	- invites	invite ID (SecretID) of the slot, sorted too : the invite IDs
+				are handed out in digest order, so both lookups are a bisect
+	- answer	0 while the invite is unused, else 1 + index in self.answers
+	- vkeys		verification key handed out when the vote was cast
+
+	which amounts to about 36 bytes per voter (plus the distinct answers).
+	see bench_memory.py
+
+	once the poll is closed, freeze() compacts it into a FrozenBallot : the
+	(invite ID, verification key, answer) of the votes cast only, the
+	digests and unused invites are gone. a FrozenBallot can be saved to a
+	snapshot file and served from an mmap by other processes (verifier.py)
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+from secrets import randbits
+
+DIGEST_SIZE = 16	# bytes ; collisions are not a concern below billions of voters
+
+# FrozenBallot snapshots (little-endian) : MAGIC, votes, slots, open invites,
+# distinct answers, answer index typecode, poll ID ; then the invites, vkeys
+# and answer index arrays, then (votes, length, answer) for every distinct answer
+SNAPSHOT_MAGIC = b'E2VFB\x00\x00\x02'
+SNAPSHOT_HEADER = struct.Struct( '<8sQQQQc7x16s' )
+SNAPSHOT_ANSWER = struct.Struct( '<QI' )
+
+def digest( full_id ):
+	return blake2b( full_id, digest_size = DIGEST_SIZE ).digest()
+
+class _Digests:
+	"""
+		sequence view over the packed digests, for bisect
+	"""
+	def __init__( self, buf ):
+		self.buf = buf
+
+	def __len__( self ):
+		return len(self.buf) // DIGEST_SIZE
+
+	def __getitem__( self, i ):
+		return bytes( self.buf[i*DIGEST_SIZE:(i+1)*DIGEST_SIZE] )
+
+
+class BallotStore:
+	"""
+
+		invites and results of a BallotMiddleMan, in fixed-width slots
+
+		full_ids and invite_ids are two sequences of the same length (one
+		item per voter) ; invite IDs must be unique, they are assigned to the
+		voters in the order of their digests (which reveals nothing)
+
+	"""
+	def __init__( self, full_ids, invite_ids ):
+		# the digests are uniformly distributed : they go to buckets by their
+		# first bits, packed, and each bucket is sorted on its own ; only one
+		# bucket at a time is bytes objects, so building the store does not
+		# take (much) more memory than the store itself
+		bits = min( 16, ( len(full_ids) // 64 ).bit_length() )
+		buckets = [ bytearray() for _ in range(1 << bits) ]
+		for f in full_ids:
+			d = digest( f )
+			buckets[ int.from_bytes( d[:2] ) >> (16-bits) ] += d
+		n = sum( len(b) for b in buckets ) // DIGEST_SIZE
+		self.digests = bytearray( n*DIGEST_SIZE )
+		offset = 0
+		for i, bucket in enumerate(buckets):
+			records = sorted( bytes(bucket[j:j+DIGEST_SIZE]) for j in range(0, len(bucket), DIGEST_SIZE) )
+			self.digests[offset:offset+len(bucket)] = b''.join(records)
+			offset += len(bucket)
+			buckets[i] = None
+		del buckets, records
+		self._digests = _Digests( self.digests )
+		self.invites = array( 'Q', sorted(invite_ids) )
+		self.answer = array( 'I', [0] ) * n		# without a temporary bytes(4*n)
+		self.vkeys = array( 'Q', [0] ) * n
+
+		self.answers = []			# distinct answers
+		self.answers_index = {}		# answer -> index in self.answers
+
+		self.open_invites = n
+		self.votes = 0
+
+	def __len__( self ):
+		return len(self.invites)
+
+	def duplicates( self ):
+		"""
+			number of full voter IDs that appear more than once
+		"""
+		d = self._digests
+		return sum( d[i] == d[i+1] for i in range(len(d)-1) )
+
+	def slot( self, full_id ):
+		key = digest( full_id )
+		i = bisect_left( self._digests, key )
+		if i == len(self.invites) or self._digests[i] != key:
+			raise KeyError( full_id )
+		return i
+
+	def slot_by_invite( self, invite_id ):
+		i = bisect_left( self.invites, invite_id )
+		if i == len(self.invites) or self.invites[i] != invite_id:
+			raise KeyError( invite_id )
+		return i
+
+	def invite( self, full_id ):
+		"""
+			the invite ID of a voter who has not voted yet (KeyError otherwise)
+		"""
+		i = self.slot( full_id )
+		if self.answer[i]:
+			raise KeyError( full_id )
+		return self.invites[i]
+
+	def cast( self, full_id, invite_id, value ):
+		"""
+			records a vote and returns its verification key ; KeyError if the
+			voter is unknown, has already voted or the invite ID does not match
+		"""
+		i = self.slot( full_id )
+		if self.answer[i] or self.invites[i] != invite_id:
+			raise KeyError( full_id )
+		try:
+			a = self.answers_index[value]
+		except KeyError:
+			a = self.answers_index[value] = len(self.answers)
+			self.answers.append( value )
+		vkey = randbits(47) | 1		# never zero ; the size of a memory address, like the invite IDs
+		self.vkeys[i] = vkey
+		self.answer[i] = a + 1
+		self.open_invites -= 1
+		self.votes += 1
+		return vkey
+
+	def verify( self, invite_id, vkey ):
+		"""
+			the answer recorded for (invite ID, verification key), KeyError if none
+		"""
+		i = self.slot_by_invite( invite_id )
+		if not self.answer[i] or self.vkeys[i] != vkey:
+			raise KeyError( invite_id )
+		return self.answers[ self.answer[i] - 1 ]
+
+	def verify_many( self, invite_ids, vkeys ):
+		"""
+			verify() for two sequences of probes at once ; returns the hits as
+			a list of (position in the sequences, answer)
+		"""
+		invites, answer, stored_vkeys, answers = self.invites, self.answer, self.vkeys, self.answers
+		n = len(invites)
+		hits = []
+		for p, (invite_id, vkey) in enumerate(zip(invite_ids, vkeys)):
+			i = bisect_left( invites, invite_id )
+			if i < n and invites[i] == invite_id and answer[i] and stored_vkeys[i] == vkey:
+				hits.append(( p, answers[answer[i]-1] ))
+		return hits
+
+	def nbytes( self ):
+		"""
+			memory used by the slot arrays (the distinct answers not included)
+		"""
+		return len(self.digests) + sum( a.itemsize*len(a) for a in (self.invites, self.answer, self.vkeys) )
+
+	def freeze( self ):
+		return FrozenBallot( self )
+
+
+class FrozenBallot:
+	"""
+
+		read-only results of a closed poll (see BallotStore.freeze()) :
+		verify() and verify_many() as before, invite() and cast() always
+		raise KeyError ; tally is the final {answer: votes}, computed once
+
+	"""
+	def __init__( self, store ):
+		n = len(store)
+		voted = [ i for i in range(n) if store.answer[i] ]
+		self.answers = tuple( store.answers )
+		# answer indexes in the smallest array type that holds them
+		typecode = 'B' if len(self.answers) < 1<<8 else 'H' if len(self.answers) < 1<<16 else 'I'
+		self.invites = array( 'Q', [ store.invites[i] for i in voted ] )
+		self.vkeys = array( 'Q', [ store.vkeys[i] for i in voted ] )
+		self.answer = array( typecode, [ store.answer[i] - 1 for i in voted ] )
+		counts = [0] * len(self.answers)
+		for a in self.answer:
+			counts[a] += 1
+		self.tally = dict( zip( self.answers, counts ) )
+		self.open_invites = store.open_invites		# can no longer be used, but still add up to the roll
+		self.votes = store.votes
+		self.slots = n
+		self.poll = None		# the poll ID, once saved or loaded
+
+	def __len__( self ):
+		return self.slots
+
+	def invite( self, full_id ):
+		raise KeyError( full_id )
+
+	def cast( self, full_id, invite_id, value ):
+		raise KeyError( full_id )
+
+	def verify( self, invite_id, vkey ):
+		invites = self.invites
+		i = bisect_left( invites, invite_id )
+		if i == len(invites) or invites[i] != invite_id or self.vkeys[i] != vkey:
+			raise KeyError( invite_id )
+		return self.answers[ self.answer[i] ]
+
+	def verify_many( self, invite_ids, vkeys ):
+		invites, answer, stored_vkeys, answers = self.invites, self.answer, self.vkeys, self.answers
+		n = len(invites)
+		hits = []
+		for p, (invite_id, vkey) in enumerate(zip(invite_ids, vkeys)):
+			i = bisect_left( invites, invite_id )
+			if i < n and invites[i] == invite_id and stored_vkeys[i] == vkey:
+				hits.append(( p, answers[answer[i]] ))
+		return hits
+
+	def nbytes( self ):
+		return sum( a.itemsize*len(a) for a in (self.invites, self.answer, self.vkeys) )
+
+	def save( self, path, poll ):
+		"""
+			writes a snapshot for load() ; atomic (written aside, then renamed).
+			`poll` (the poll ID, up to 16 ASCII characters) tells the results
+			of one poll from another's
+		"""
+		self.poll = poll
+		tmp = path + '.tmp'
+		with open( tmp, 'wb' ) as f:
+			f.write( SNAPSHOT_HEADER.pack( SNAPSHOT_MAGIC, self.votes, self.slots, self.open_invites,
+					len(self.answers), self.answer.typecode.encode(), poll.encode('ascii') ) )
+			for a in (self.invites, self.vkeys, self.answer):
+				if sys.byteorder == 'big':
+					a = array( a.typecode, a )
+					a.byteswap()
+				a.tofile( f )
+			for answer in self.answers:
+				f.write( SNAPSHOT_ANSWER.pack( self.tally[answer], len(answer) ) + answer )
+		os.replace( tmp, path )
+
+	@classmethod
+	def load( cls, path ):
+		"""
+			a FrozenBallot served from the snapshot at `path`, mmap'd : the
+			processes that load the same file share its pages
+		"""
+		with open( path, 'rb' ) as f:
+			mm = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+		magic, votes, slots, open_invites, n, typecode, poll = SNAPSHOT_HEADER.unpack_from( mm )
+		if magic != SNAPSHOT_MAGIC:
+			raise ValueError(f"{path} is not a ballot snapshot")
+		if sys.byteorder == 'big':
+			raise RuntimeError("ballot snapshots are little-endian")
+		self = cls.__new__( cls )
+		self.mm = mm
+		view = memoryview( mm )
+		offset = SNAPSHOT_HEADER.size
+		arrays = []
+		for code in ( 'Q', 'Q', typecode.decode() ):
+			size = votes * array(code).itemsize
+			arrays.append( view[offset:offset+size].cast(code) )
+			offset += size
+		self.invites, self.vkeys, self.answer = arrays
+		answers, self.tally = [], {}
+		for _ in range(n):
+			count, size = SNAPSHOT_ANSWER.unpack_from( mm, offset )
+			offset += SNAPSHOT_ANSWER.size
+			answers.append( mm[offset:offset+size] )
+			self.tally[ answers[-1] ] = count
+			offset += size
+		self.answers = tuple( answers )
+		self.votes, self.slots, self.open_invites = votes, slots, open_invites
+		self.poll = poll.rstrip(b'\x00').decode('ascii')
+		return self
@@ -1,17 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # vim: ts=4 noet number nowrap
-from quart import Quart, render_template, websocket
+from quart import Quart, render_template, websocket, request
 import json
-import base64
 from datetime import datetime
 #from threading import Thread
 import devel
-from shared_funcs import enc, dec, int_as_bytes
+import metrics
+from shared_funcs import enc, dec, RateLimiter
 import asyncio
-from constants import LISTEN, ENCODING, DATETIME_FMT
+from constants import LISTEN, ENCODING, DATETIME_FMT, PROBE_RATE, PROBE_BURST
+from verifier import verify_request
 
 app = Quart(__name__)
+app.probe_quota = RateLimiter( PROBE_RATE, PROBE_BURST )
 
 @app.route("/")
 async def index():
@@ -25,42 +27,110 @@ async def index():
 
 @app.route("/config.json")
 async def json_api():
-	# TODO write a function that does this a bit more automatically and re-usable for other projects
-	#print(app.BMM.trustees)
-	return json.dumps( {dec(base64.b64encode(key)): dec(base64.b64encode(val)) for key, val in (
-		( b"authority", app.BMM.authority ),
-		( b"question", app.BMM.question ),
-		#( b"poll_opens", enc(datetime.strptime(app.BMM.poll_opens, DATETIME_FMT)) ),    # is there a better way? this seems barely acceptable, TODO i'ts broken
-		#( b"poll_closes", enc(datetime.strptime(app.BMM.poll_closes, DATETIME_FMT)) ),    # is there a better way? this seems barely acceptable, TODO it's broken
-		( b"poll_port", int_as_bytes(app.BMM.ballot_server_port) ),
-		( b"anticipated_results", enc(str(app.BMM.anticipated_results)) ),
-	)})
+	if app.BMM.phase != 'ready':
+		return json.dumps( app.BMM.startup_progress() ), 503, {"Retry-After": "10"}
+	# serialized once, with an ETag (see http_cache.py)
+	return app.BMM.document('config').send( request )
 
 @app.route("/trustees.json")
 async def trustees_api():
 	#print(app.BMM.trustees)
-	return json.dumps( {dec(base64.b64encode(key)): dec(base64.b64encode(val)) for key, val in (
-		# using a string like that is not exactly great practice... fortunately we only expect ASCII chars here (host:port)
-		( b"trustees", enc('\n'.join([':'.join([dec(t[0]),dec(t[1])]) for t in app.BMM.trustees])) ),
-	)})
+	return app.BMM.document('trustees').send( request )
+
+@app.route("/voters/")
+async def voters_api():
+	"""
+		the public voters list (see voter_roll.py) : ?format=text (default)
+		or json ; one page per request (?cursor=, 0 by default), or all of
+		it with ?stream=1
+	"""
+	if ( roll := app.BMM.roll ) is None:
+		return "the voters list is not loaded yet", 503, {"Retry-After": "10"}
+	fmt = request.args.get('format', 'text')
+	if fmt not in roll.pages:
+		return "format is text or json", 400
+	if request.args.get('stream', '').lower() in ( '1', 'true', 'yes' ):
+		return roll.stream( fmt, request )
+	try:
+		return roll.page( fmt, request.args.get('cursor', 0) ).send( request )
+	except KeyError:
+		return "invalid cursor", 400
+
+@app.route("/changes")
+async def changes_api():
+	"""
+		the votes cast after sequence number ?since= (0 by default), as JSON
+		lines (see change_log.py) ; only when the results are available
+	"""
+	if app.BMM.phase != 'ready' or not app.BMM.results_available():
+		return "Results are not available at the moment", 403
+	try:
+		since = int(request.args.get('since', 0))
+	except ValueError:
+		return "since is a sequence number", 400
+	body, headers = app.BMM.changes.stream( since )
+	return body, 200, headers
+
+@app.route("/verify", methods=["POST"])
+async def verify_api():
+	"""
+		batch verification for observers, see verifier.verify_request() ;
+		once the poll is closed, verifier.py can serve it from several
+		processes instead
+	"""
+	if app.BMM.phase != 'ready':
+		return json.dumps( app.BMM.startup_progress() ), 503, {"Retry-After": "10"}
+	return await verify_request( app.BMM.verify_votes, app.probe_quota )
+
+@app.route("/health")
+async def health_api():
+	"""
+		liveness : the HTTP server answers and startup did not fail
+	"""
+	progress = app.BMM.startup_progress()
+	progress['loop_lag'] = metrics.LOOP_LAG.values.get( (), 0. )
+	return json.dumps( progress ), 503 if app.BMM.phase == 'failed' else 200, {"Content-Type": "application/json"}
+
+@app.route("/ready")
+async def ready_api():
+	"""
+		readiness : the poll is open (invites generated, listeners started)
+		; until then, the startup phase and progress are reported with a 503
+	"""
+	return json.dumps( app.BMM.startup_progress() ), 200 if app.BMM.phase == 'ready' else 503, {"Content-Type": "application/json"}
+
+@app.route("/metrics")
+async def metrics_api():
+	return metrics.exposition(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 @app.websocket("/ws")
 async def ws():
-	while True:
-		await websocket.send("hello")
-		await websocket.send_json({"hello": "world"})
+	"""
+		live turnout, and results when they may be shown (see live_feed.py)
+		; the connection is closed if the client does not keep up
+	"""
+	if app.BMM.phase != 'ready':
+		return "the poll is not open yet", 503
+	subscriber = app.BMM.feed.subscribe()
+	try:
+		while ( frame := await subscriber.get() ) is not None:
+			await websocket.send( frame )
+	finally:
+		app.BMM.feed.unsubscribe( subscriber )
 
 @app.before_serving
 async def startup():
 	loop = asyncio.get_event_loop()
 	from ballotter_core import BallotMiddleMan
-	app.BMM = await BallotMiddleMan.init( loop, authority, question, trustees, voters, host, ENCODING )
+	# HTTP is served during startup, so /ready and /health can report progress
+	app.BMM = BallotMiddleMan( loop, authority, question, trustees, voters, host, ENCODING )
+	app.startup_task = loop.create_task( app.BMM.start() )
 
 @app.after_serving
 async def shutdown():
 	#app.smtp_server.close()
 	# TODO close other listening threads
-	pass
+	await app.BMM.stop_publishing()
 
 async def http_run( loop, authority, host, port ):
 	#t = Thread(target=app.run, args={ 'host':host, 'port':port })
@@ -6,11 +6,26 @@
     ballot middleman instance
 """
 import asyncio
-import logging
+import base64
+import json
+import os
+import time
 import pendulum
-
-from shared_funcs import dec, enc, voter_full_id, send_bytes, recv_bytes, int_as_bytes
-from constants import ENCODING, PORT_INVITES, PORT_POLLING, PORT_HTTP, TIMEZONE, LISTEN, INVITE_ERROR_INT
+from collections import Counter
+
+from shared_funcs import dec, enc, voters_full_ids, parse_trustees, replicas, RateLimiter, send_bytes, recv_bytes, recv_into, encode_frame, int_as_bytes, FrameTooLarge
+from constants import ENCODING, PORT_INVITES, PORT_POLLING, PORT_HTTP, TIMEZONE, POLL_CLOSE_CHECK, LISTEN, INVITE_ERROR_INT, POLL_SESSION, POLL_SESSION_BUFFER, STARTUP_PROGRESS_INTERVAL, PREFILTER_FP_RATE, POLL_SOURCE_RATE, POLL_SOURCE_BURST, VERIFY_SNAPSHOT
+from constants import STATS_SNAPSHOT, STATS_SNAPSHOT_INTERVAL
+from constants import POLL_MAX_INFLIGHT, POLL_MAX_QUEUE, POLL_QUEUE_DEADLINE, POLL_READ_TIMEOUT, POLL_BUSY, POLL_BUSY_RETRY
+from ballot_store import BallotStore, DIGEST_SIZE, digest
+from prefilter import CountingBloomFilter
+import metrics
+from journal import JOURNAL
+from stats_snapshot import SharedSnapshot
+from http_cache import CachedDocument
+from voter_roll import VoterRoll
+from live_feed import LiveFeed
+from change_log import ChangeLog
 import devel
 
 STATS = None	# global ; will be dict
@@ -39,27 +54,108 @@ class BallotMiddleMan:
 		self.question = question	# it's good to know what question we're answering
 		self.host = host			# the same for all services
 		self.encoding = encoding	# encoding everything to ensure consistency of the data
+		self.poll_id = os.urandom( 8 ).hex()	# tells this poll from the previous ones, see close_poll()
+		self.ballot_server_port = PORT_POLLING	# see open_poll()
 		self.total_possible_votes = len(voters)
 		self.voters = voters
-		self.trustees = trustees
-		self.result = {}
+		self.roll = None			# the voters list as served at /voters/, see voter_roll.py
+		self.trustees, self.stats = parse_trustees( trustees )	# a trustee may be a replica set
+		self.store = None			# invites and results, see ballot_store.py
+		self.prefilter = None		# voters who may still vote, see prefilter.py
+		self.source_quota = RateLimiter( POLL_SOURCE_RATE, POLL_SOURCE_BURST )
+		self.slots = asyncio.Semaphore( POLL_MAX_INFLIGHT )	# admission control on PORT_POLLING
+		self.inflight = 0
+		self.queued = 0
+		self.sessions = set()		# writers of the polling sessions, closed by close_poll()
+		self.tally = Counter()		# answer -> votes, kept up to date by submit_vote()
+		self.closed = asyncio.Event()	# set by close_poll()
+		self.results = None			# final tally, once closed
+		self.vote_meter = metrics.Meter()
+		self.feed = LiveFeed( self )	# /ws, see live_feed.py
+		self.changes = ChangeLog()	# /changes, see change_log.py
+		self.changed = asyncio.Event()	# wakes publish_stats() up
+		self.documents = {}			# name -> CachedDocument, see document()
+		# startup phase, see start() and startup_progress()
+		self.phase = 'starting'
+		self.resolved = 0			# voters resolved by every trustee
+		self.startup_began = time.monotonic()
+		self.invites_began = None
+		self.invites_done = None
+		self.last_report = None
+		self.error = None
+
+	@property
+	def phase( self ):
+		return self._phase
+
+	@phase.setter
+	def phase( self, phase ):
+		self._phase = phase
+		self.changed.set()
 
 	@classmethod
 	async def init( self, loop, authority, question, trustees, voters, host, encoding = 'utf-8' ):
 		self = BallotMiddleMan( loop, authority, question, trustees, voters, host, encoding )
+		try:
+			await self.start()
+		except BaseException:
+			await self.stop_publishing()	# nobody is left to report the failure to
+			raise
+		return self
 
-		# preparing trust authorities
-		self.trustees = [ ( *t.split(b'\t',2)[:2], ) for t in trustees ]
-		STATS = {( *t.split(b'\t',2)[:2], ): {'alias': t.rsplit(b'\t',1)[-1]} for t in trustees}
-
-		print("generating invites...", end=' ')
-		# the value id(v) is not used, it's just a redundant placeholder that may be used for verification
-		self.invites = { await voter_full_id(v, self.trustees, STATS, (host, PORT_POLLING) ): id(v) for v in voters}
+	async def start( self ):
+		"""
+			everything it takes to open the poll : connects to the trust
+			authorities, generates the invites and starts the listeners
 
-		if len(self.invites) != self.total_possible_votes:	# should be unnecessary, just a safety measure
-			raise Exception("INIT: Number of invites does not match number of electors ({len(self.invites)}/{len(self.total_possible_votes})")
-		else:
-			print("done!")
+			the HTTP server does not wait for this (see ballotter.py) ; the
+			current phase is self.phase, see startup_progress()
+		"""
+		self.publisher = self.loop.create_task( self.publish_stats() )
+		# pages of the public voters list, built meanwhile (gzip does not hold the GIL)
+		roll = asyncio.ensure_future( asyncio.to_thread( VoterRoll, self.voters ) )
+		listeners = []
+		try:
+			self.phase = 'generating invites'
+			self.invites_began = time.monotonic()
+			print("generating invites...")
+			# the whole roll is resolved with the trustees' batch mode (a few connections per trustee)
+			full_ids = await voters_full_ids( self.voters, self.trustees, self.stats, (self.host, PORT_POLLING), self.invites_progress )
+			if full_ids is None:
+				raise Exception("INIT: some trustee did not respond, cannot generate invites")
+			# invite IDs are the id(v) values : unique while self.voters lives, and handed out in the (meaningless) order of the digests
+			self.store = BallotStore( full_ids, [ id(v) for v in self.voters ] )
+
+			if self.store.duplicates():	# should be unnecessary, just a safety measure
+				raise Exception(f"INIT: Number of invites does not match number of electors ({len(self.store)-self.store.duplicates()}/{self.total_possible_votes})")
+			else:
+				self.invites_done = time.monotonic()
+				print(f"done! ({self.total_possible_votes} invites in {self.invites_done-self.invites_began:.1f}s)")
+			del full_ids
+			self.build_prefilter()
+			self.roll = await roll
+
+			# TODO make a a prompt or config of some sort for this value
+			self.anticipated_results = False
+
+			# ready once both ports are bound (one may be taken already)
+			listening = [ self.loop.create_future() for _ in range(2) ]
+			listeners = [
+					self.loop.create_task( self.open_poll( listening = listening[0] ) ),
+					self.loop.create_task( self.invites_listener( listening = listening[1] ) ),
+				]
+			errors = [ e for e in await asyncio.gather( *listening, return_exceptions = True ) if e is not None ]
+			if errors:
+				raise errors[0]
+		except Exception as e:
+			self.phase = 'failed'
+			self.error = repr(e)
+			# nothing keeps going : the listener that could bind (no vote may
+			# be accepted) and the roll, if it is still being built
+			for task in [ roll, *listeners ]:
+				task.cancel()
+			await asyncio.gather( roll, *listeners, return_exceptions = True )
+			raise
 
 		# devel leftover, keeping for now. this should only be done on request!
 		#for v in voters:
@@ -69,14 +165,163 @@ class BallotMiddleMan:
 		#		# this is just here for the example
 		#		print(f'''ERROR: cannot get ballot paper for {v}''')
 
-		# TODO make a a prompt or config of some sort for this value
-		self.anticipated_results = False
+		metrics.INTEGRITY.function = self.ballot_integrity_check
+		metrics.POLL_INFLIGHT.function = lambda: self.inflight
+		metrics.POLL_QUEUED.function = lambda: self.queued
+		self.loop.create_task( metrics.monitor_loop_lag() )
+		self.loop.create_task( self.feed.run() )
 
 		print("ballot server is ready :-)")
-		loop.create_task( self.open_poll() )
-		loop.create_task( self.invites_listener() )
-		return self
+		self.phase = 'ready'
+
+	def build_prefilter( self ):
+		"""
+			the voters who may still vote, from the digests of the store
+		"""
+		self.prefilter = CountingBloomFilter( len(self.store), PREFILTER_FP_RATE )
+		digests = memoryview( self.store.digests )
+		for i in range(0, len(digests), DIGEST_SIZE):
+			if not self.store.answer[ i // DIGEST_SIZE ]:
+				self.prefilter.add( digests[i:i+DIGEST_SIZE] )
+		digests.release()
+
+	def invites_progress( self, resolved ):
+		"""
+			called by voters_full_ids() ; reports at most every STARTUP_PROGRESS_INTERVAL seconds
+		"""
+		self.resolved = resolved
+		now = time.monotonic()
+		if resolved == self.total_possible_votes or self.last_report is None or now - self.last_report >= STARTUP_PROGRESS_INTERVAL:
+			self.last_report = now
+			p = self.startup_progress()
+			JOURNAL.info( 'generating invites', resolved = f"{resolved}/{self.total_possible_votes}", rate = f"{p['rate']}/s", eta = f"{p['eta']}s" )
+
+	def startup_progress( self ):
+		"""
+			what /ready and /health report : the startup phase and, while
+			generating invites, voters resolved, rate (voters per second)
+			and ETA (seconds)
+		"""
+		progress = { 'phase': self.phase, 'uptime': round( time.monotonic()-self.startup_began, 1 ) }
+		if self.invites_began is not None:
+			elapsed = ( self.invites_done or time.monotonic() ) - self.invites_began
+			rate = self.resolved / elapsed if elapsed else 0.
+			progress.update({
+					'resolved': self.resolved,
+					'total': self.total_possible_votes,
+					'rate': round( rate, 1 ),
+					'eta': round( (self.total_possible_votes-self.resolved) / rate, 1 ) if rate else None,
+				})
+		if self.error is not None:
+			progress['error'] = self.error
+		return progress
 	
+	def config_json( self ):
+		"""
+			/config.json : what a voter needs to know about this poll,
+			base64-encoded keys and values
+		"""
+		# TODO write a function that does this a bit more automatically and re-usable for other projects
+		return json.dumps( {dec(base64.b64encode(key)): dec(base64.b64encode(val)) for key, val in (
+			( b"authority", self.authority ),
+			( b"question", self.question ),
+			#( b"poll_opens", enc(datetime.strptime(self.poll_opens, DATETIME_FMT)) ),    # is there a better way? this seems barely acceptable, TODO i'ts broken
+			#( b"poll_closes", enc(datetime.strptime(self.poll_closes, DATETIME_FMT)) ),    # is there a better way? this seems barely acceptable, TODO it's broken
+			( b"poll_port", int_as_bytes(self.ballot_server_port) ),
+			( b"anticipated_results", enc(str(self.anticipated_results)) ),
+		)})
+
+	def trustees_json( self ):
+		"""
+			/trustees.json
+		"""
+		return json.dumps( {dec(base64.b64encode(key)): dec(base64.b64encode(val)) for key, val in (
+			# using a string like that is not exactly great practice... fortunately we only expect ASCII chars here (host:port)
+			# ; the replicas of a trustee are on the same line, comma-separated
+			( b"trustees", enc('\n'.join([ ','.join([ ':'.join([dec(h),dec(p)]) for h, p in replicas(t) ]) for t in self.trustees ])) ),
+		)})
+
+	def document( self, name ):
+		"""
+			config_json() ('config') or trustees_json() ('trustees') as an
+			http_cache.CachedDocument, serialized again only when what it is
+			built from changed
+		"""
+		if name == 'config':
+			key, build = ( self.ballot_server_port, self.anticipated_results ), self.config_json
+		else:
+			key, build = None, self.trustees_json	# the trustees do not change
+		doc = self.documents.get( name )
+		if doc is None or not doc.fresh( key ):
+			doc = self.documents[name] = CachedDocument( build(), key )
+		return doc
+
+	def public_state( self ):
+		"""
+			everything the HTTP pages show, JSON-serializable (answers are
+			base64-encoded) ; see publish_stats()
+		"""
+		ready = self.store is not None and self.phase == 'ready'
+		results = self.concatenate_votes() if ready else None
+		return {
+			'phase': self.phase,
+			'progress': self.startup_progress(),
+			'authority': dec(self.authority),
+			'question': dec(self.question),
+			'poll_opens': str(getattr( self, 'poll_opens', '' )),
+			'poll_closes': str(getattr( self, 'poll_closes', '' )),
+			'anticipated_results': getattr( self, 'anticipated_results', False ),
+			'closed': self.closed.is_set(),
+			'voters': self.total_possible_votes,
+			'votes': self.votes_count() if ready else 0,
+			'poll_progress': self.poll_progress() if ready else 0.,
+			'vote_frequency': self.vote_frequency(),
+			# None while the results are not available
+			'results': { dec(base64.b64encode(a)): n for a, n in results.items() } if isinstance( results, Counter ) else None,
+			'integrity': self.ballot_integrity_check() if ready else None,
+			'loop_lag': metrics.LOOP_LAG.values.get( (), 0. ),
+			'config': self.document('config').body.decode() if ready else None,
+			'trustees': self.document('trustees').body.decode(),
+		}
+
+	async def publish_stats( self, path = STATS_SNAPSHOT ):
+		"""
+			publishes public_state() to the shared snapshot at `path`
+			(formatted with the polling port, see stats_snapshot.py) every
+			STATS_SNAPSHOT_INTERVAL seconds, and as soon as self.changed is
+			set ; the snapshot is removed when the task is cancelled, see
+			stop_publishing()
+		"""
+		path = path.format( port = self.ballot_server_port )
+		try:
+			snapshot = SharedSnapshot( path, create = True )
+		except OSError as e:
+			JOURNAL.warning( 'no stats snapshot', path = path, error = repr(e) )
+			return
+		try:
+			while True:
+				self.changed.clear()
+				try:
+					snapshot.publish( self.public_state() )
+				except Exception as e:
+					JOURNAL.error( 'stats snapshot failed', error = repr(e) )
+				# not wait_for() : it can swallow a cancellation that comes along with self.changed
+				try:
+					async with asyncio.timeout( STATS_SNAPSHOT_INTERVAL ):
+						await self.changed.wait()
+				except TimeoutError:
+					pass
+		finally:
+			snapshot.close()
+
+	async def stop_publishing( self ):
+		"""
+			stops publish_stats(), which removes the snapshot : the dashboards
+			must not serve the state of a ballot server that is gone
+		"""
+		self.publisher.cancel()
+		await asyncio.gather( self.publisher, return_exceptions = True )
+
 	async def http_listen( self, port = PORT_HTTP ):
 		"""
 			starts an HTTP server to display running statistics, such as:
@@ -99,56 +344,127 @@ class BallotMiddleMan:
 		await http_run( self.loop, self.authority, self.host, port )
 	
 	async def invites_callback( self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
-		voter_id = await recv_bytes( reader )
+		try:
+			voter_id = await recv_bytes( reader )
+		except (asyncio.IncompleteReadError, FrameTooLarge) as e:
+			JOURNAL.warning( 'invalid invite request', error = repr(e) )
+			writer.close()
+			return await writer.wait_closed()
 		try:
 			inviteID = self.request_auth( voter_id )
 		except KeyError:
-			print(f"WARNING: failed fetching invite for {voter_id} (unkown user)")
+			metrics.INVITE_REQUESTS.inc( 'unknown' )
+			JOURNAL.warning( 'invite unknown voter', voter = voter_id )
 			await send_bytes( writer, int_as_bytes(INVITE_ERROR_INT) )
 		else:
-			print(f"fetching invite for {voter_id}: {hex(inviteID)}")
+			metrics.INVITE_REQUESTS.inc( 'ok' )
+			JOURNAL.info( 'invite', voter = voter_id, invite = hex(inviteID) )
 			await send_bytes( writer, int_as_bytes(inviteID) )
 		#print("done sending", hex(inviteID))
 		writer.close()
 		await writer.wait_closed()
 		
-	async def invites_listener(self, port = PORT_INVITES ):
+	async def invites_listener(self, port = PORT_INVITES, listening = None ):
 		"""
 
-			opens a port to listen for invites requests
+			opens a port to listen for invites requests ; `listening` (a
+			future) gets None once it is bound, or the exception if it cannot be
 
 			TODO: host (listening address) may differ from self.host (public
 			address used for PORT_HTTP and PORT_POLLING ; PORT_POLLING may also
 			have a distinct value because of a VPN that may exist)
 
 		"""
-		server = await asyncio.start_server(self.invites_callback, self.host, port)
+		try:
+			server = await asyncio.start_server(self.invites_callback, self.host, port)
+		except Exception as e:
+			if listening is None:
+				raise
+			return listening.set_exception( e )
+		if listening is not None:
+			listening.set_result( None )
 		address = ', '.join(str(sock.getsockname()) for sock in server.sockets)
 		print(f"{self.authority}: listening for invites requests on {address}")
 
 		async with server:
-			await server.serve_forever()
+			await server.start_serving()
+			await self.closed.wait()
 
-	async def open_poll( self, poll_opens = pendulum.now(TIMEZONE), poll_duration = {'days': 1}, port = PORT_POLLING ):
+	async def open_poll( self, poll_opens = None, poll_duration = {'days': 1}, port = PORT_POLLING, listening = None ):
 		"""
 
-			opens the port to listen for incoming votes
+			opens the port to listen for incoming votes ; `listening` as for
+			invites_listener()
 
 		"""
 		self.ballot_server_port = port
-		self.poll_opens = poll_opens
+		self.poll_opens = poll_opens or pendulum.now(TIMEZONE)	# by default, when the poll opens rather than at import
 		if poll_duration is None:
 			raise Exception("TODO make this interactive")
 		else:
 			self.poll_closes = self.poll_opens.add(**poll_duration)
-		print(f'''The question, open to {len(self.invites)} voters, is :\n\t"{dec(self.question)}" ; it is open since {self.poll_opens} until {self.poll_closes}''')
-		server = await asyncio.start_server(self.ballot_server_callback, self.host, port)
+		print(f'''The question, open to {self.store.open_invites} voters, is :\n\t"{dec(self.question)}" ; it is open since {self.poll_opens} until {self.poll_closes}''')
+		# the reader limit bounds what a pipelining client can push ahead of us
+		try:
+			server = await asyncio.start_server(self.ballot_server_callback, self.host, port, limit = POLL_SESSION_BUFFER)
+		except Exception as e:
+			if listening is None:
+				raise
+			return listening.set_exception( e )
+		if listening is not None:
+			listening.set_result( None )
+		# the results a previous poll on this port published are not this one's
+		try:
+			os.unlink( VERIFY_SNAPSHOT.format( port = port ) )
+		except FileNotFoundError:
+			pass
 		address = ', '.join(str(sock.getsockname()) for sock in server.sockets)
 		print(f"{self.authority}: listening for votes on {address}")
 		#logging.info(f'Serving on {address}')
 
 		async with server:
-			await server.serve_forever()
+			await server.start_serving()
+			# the scheduler : waiting in short steps, so a clock change is noticed
+			# ; close_poll() may also be called earlier
+			while not self.closed.is_set() and ( remaining := (self.poll_closes - pendulum.now(TIMEZONE)).total_seconds() ) > 0:
+				try:
+					await asyncio.wait_for( self.closed.wait(), min( remaining, POLL_CLOSE_CHECK ) )
+				except asyncio.TimeoutError:
+					pass
+			# before leaving the block : the server waits for the connections, sessions included
+			self.close_poll()
+
+	def close_poll( self, snapshot = VERIFY_SNAPSHOT ):
+		"""
+			no more votes : the listeners stop (submissions already accepted
+			are still served), the results are frozen (see
+			ballot_store.FrozenBallot) and everything that was only needed
+			to vote is released
+
+			the frozen results are published to `snapshot` (unless None ;
+			formatted with the polling port) for the verification workers,
+			with the poll ID : see verifier.py
+		"""
+		if self.closed.is_set():
+			return
+		self.prefilter = frozenset()	# nobody may vote anymore (a submission still in flight is 'filtered')
+		self.store = self.store.freeze()
+		if self.store.tally != { a: n for a, n in self.tally.items() if n }:
+			JOURNAL.error( 'tally mismatch', frozen = self.store.tally, running = dict(self.tally) )
+		self.results = Counter( self.store.tally )
+		self.closed.set()
+		self.changed.set()
+		for writer in self.sessions:
+			writer.close()			# their loop sees the poll closed, see session_callback()
+		JOURNAL.info( 'poll closed', votes = self.store.votes, bytes = self.store.nbytes() )
+		if snapshot is not None:
+			snapshot = snapshot.format( port = self.ballot_server_port )
+			try:
+				self.store.save( snapshot, self.poll_id )
+				JOURNAL.info( 'snapshot published', path = snapshot )
+			except OSError as e:
+				JOURNAL.error( 'snapshot failed', path = snapshot, error = repr(e) )
+		print(f"{self.authority}: the poll is closed ({self.store.votes}/{self.total_possible_votes} votes)")
 
 	def request_auth( self, voter ):
 		"""
@@ -156,33 +472,46 @@ class BallotMiddleMan:
 
 			TODO: make this one-time only? see "generating invites..." in self.init()
 		"""
-		#print(self.invites)
-		return id(self.invites[voter])
+		return self.store.invite( voter )
 
 	def submit_vote( self, voter_full_id, secret, value ):
 		"""
 			the few CPU cycles (and associated network traffic) it takes this function to execute are the _only_ 
 			places where voter/vote can be sniffed (matched)
 		"""
+		key = digest( voter_full_id )
+		if key not in self.prefilter:
+			# unknown voter or already voted : nothing else to look at
+			metrics.VOTES.inc( 'filtered' )
+			return None
 		try:
-			if id( self.invites[ voter_full_id ]) == secret:
-				self.invites.pop( voter_full_id )	# in some rare cases, may also raise KeyError
-				self.result[ secret ] = value
-				print(f"+1: {value}")
-				return id(self.result[secret])
-			else:
-				raise KeyError
+			verification_key = self.store.cast( voter_full_id, secret, value )
+			self.prefilter.discard( key )
+			self.tally[ value ] += 1
+			self.feed.vote( value )
+			self.changes.append( secret, verification_key, value )
+			metrics.VOTES.inc( 'accepted' )
+			self.vote_meter.mark()
+			JOURNAL.info( 'vote', answer = value )
+			return verification_key
 		except KeyError:
-			print(f"submit FAIL for {voter_full_id}: {value}")
-			logging.debug(f"submit FAIL for {voter_full_id}: {value}")
+			metrics.VOTES.inc( 'rejected' )
+			JOURNAL.info( 'vote rejected', voter = voter_full_id, answer = value )
 	
 	def verify_vote( self, secret, index ):
 		"""
 			by feeding 'random' data in this function, counting the number of occurences allows for statistical 
 			analysis of the integrity of the ballot (this is the so-called "brute-force" pseudo-attack)
 		"""
-		if id(self.result[secret]) == index:	return self.result[ secret ]
-		else:									raise KeyError	# to make querying cleaner ; not strictly necessary
+		return self.store.verify( secret, index )	# raises KeyError, to make querying cleaner ; not strictly necessary
+
+	def verify_votes( self, secrets, indexes ):
+		"""
+			verify_vote() for many (secret, index) probes at once, for observers
+			running the "brute-force" audit at scale ; returns the hits as a
+			list of (position of the probe, answer)
+		"""
+		return self.store.verify_many( secrets, indexes )
 	
 	def ballot_integrity_check( self ):
 		"""
@@ -190,17 +519,37 @@ class BallotMiddleMan:
 			MAY return a small negative integer for a very short while (borderline case due to concurrency issues)
 			MUST NOT return a positive value (this means some votes have been added which shouldn't have)
 		"""
-		return self.total_possible_votes - ( len(self.invites) + len(self.result) )
+		return self.total_possible_votes - ( self.store.open_invites + self.store.votes )
+
+	def results_available( self ):
+		return self.results is not None or self.anticipated_results
 
 	def concatenate_votes( self ):
 		"""
 			return a summary of the results. this data must be public at the very least when the ballot is closed
 		"""
-		if not self.anticipated_results and pendulum.now() < self.poll_closes:
+		if self.results is not None:
+			return self.results		# final, computed by close_poll()
+		elif not self.anticipated_results:
 			return "Results are not available at the moment"
 		else:
-			from collections import Counter
-			return Counter( self.result.values() )
+			# a copy of the running tally : O(distinct answers), not O(votes)
+			return Counter( self.tally )
+
+	def votes_count( self ):
+		return self.store.votes
+
+	def vote_frequency( self ):
+		"""
+			votes per minute, over the last minute
+		"""
+		return round( 60*self.vote_meter.rate(), 1 )
+
+	def poll_progress( self ):
+		"""
+			percentage of the voters who have cast their vote
+		"""
+		return round( 100*self.store.votes/self.total_possible_votes, 2 ) if self.total_possible_votes else 0.
 
 	async def ballot_server_callback( self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
 		""" Callback function for handling incoming server functions.
@@ -211,12 +560,85 @@ class BallotMiddleMan:
 		#print("\nserver_request callback executing")
 		#logging.debug("server_request callback executing")
 
-		voter_id = await recv_bytes( reader )
-		#print(f"{voter_id = }")
-		secretID = int.from_bytes(await recv_bytes( reader ))
-		#print(f"{hex(secretID) = }")
-		answer = await recv_bytes( reader )
-		#print(f"{answer = }")
+		# rejected submissions cost their source a token ; out of tokens, it is not even read
+		source = (writer.get_extra_info('peername') or ('',))[0]
+		if self.source_quota.wait( source ):
+			metrics.POLL_THROTTLED.inc()
+			writer.close()
+			return await writer.wait_closed()
+
+		if not await self.admit():
+			return await self.busy_callback( reader, writer )
+		try:
+			await self.submission_callback( reader, writer, source )
+		finally:
+			self.inflight -= 1
+			self.slots.release()
+
+	async def admit( self ):
+		"""
+			takes one of the POLL_MAX_INFLIGHT slots, waiting at most
+			POLL_QUEUE_DEADLINE seconds for it ; False if there was none
+		"""
+		if self.slots.locked():
+			if self.queued >= POLL_MAX_QUEUE:
+				return False
+			self.queued += 1
+			try:
+				await asyncio.wait_for( self.slots.acquire(), POLL_QUEUE_DEADLINE )
+			except asyncio.TimeoutError:
+				return False
+			finally:
+				self.queued -= 1
+		else:
+			await self.slots.acquire()
+		self.inflight += 1
+		return True
+
+	async def busy_callback( self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		"""
+			no slot for this connection : it gets a busy frame (POLL_BUSY and
+			the ms to wait before retrying, more if many are queued) instead
+			of a verification key
+		"""
+		metrics.POLL_BUSY.inc()
+		retry = POLL_BUSY_RETRY * ( 1 + self.queued // POLL_MAX_INFLIGHT )
+		try:
+			writer.write( encode_frame( POLL_BUSY + retry.to_bytes(4,'big') ) )
+			writer.write_eof()
+			# closing with the submission still unread would reset the connection
+			# before the client reads the busy frame : wait (a little) for it to hang up
+			await asyncio.wait_for( self.discard_input( reader ), 1 )
+		except (ConnectionError, asyncio.TimeoutError):
+			pass
+		finally:
+			writer.close()
+			await writer.wait_closed()
+
+	@staticmethod
+	async def discard_input( reader ):
+		while await reader.read( 1 << 16 ):
+			pass
+
+	async def submission_callback( self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source = None ) -> None:
+		"""
+			one (voter ID, SecretID, answer) submission, or a session (see
+			session_callback) ; the client has POLL_READ_TIMEOUT seconds per
+			frame so it cannot hold its slot forever
+		"""
+		try:
+			voter_id = await asyncio.wait_for( recv_bytes( reader ), POLL_READ_TIMEOUT )
+			#print(f"{voter_id = }")
+			if voter_id == POLL_SESSION:
+				return await self.session_callback( reader, writer, source )
+			secretID = int.from_bytes(await asyncio.wait_for( recv_bytes( reader ), POLL_READ_TIMEOUT ))
+			#print(f"{hex(secretID) = }")
+			answer = await asyncio.wait_for( recv_bytes( reader ), POLL_READ_TIMEOUT )
+			#print(f"{answer = }")
+		except (asyncio.IncompleteReadError, FrameTooLarge, asyncio.TimeoutError) as e:
+			JOURNAL.warning( 'invalid submission', error = repr(e) )
+			writer.close()
+			return await writer.wait_closed()
 		
 		verification_key = self.submit_vote(
 				voter_full_id = voter_id,
@@ -231,14 +653,66 @@ class BallotMiddleMan:
 			#logging.debug(f"Send: {r}")
 			#print(f"{verification_key = }, {type(verification_key) = }")
 			await send_bytes( writer, int_as_bytes(verification_key) )
-			print(f"got vote: {answer}")
-		#else:
+			JOURNAL.debug( 'vote receipt sent', answer = answer )
+		else:
+			self.source_quota.take( source )
 		#	print(f"WARNING: Vote could not be cast! {voter_id}: {answer}")
 	
 		# Shut down Stream
 		writer.close()
 		await writer.wait_closed()
 
+	async def session_callback( self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, source = None ) -> None:
+		"""
+
+			session mode (the first frame was POLL_SESSION) : pipelined
+			(voter ID, SecretID, answer) triples until EOF ; each one is
+			answered, in order, with a frame holding the verification key
+			(empty if the vote could not be cast)
+
+			backpressure is per connection : the reader stops pulling from
+			the socket once POLL_SESSION_BUFFER bytes are waiting, and
+			drain() blocks while as much is waiting to be read by the client
+
+			rejected submissions cost the source a token (see
+			POLL_SOURCE_RATE) ; the session ends when it runs out of them
+
+			like single submissions, each frame must come within
+			POLL_READ_TIMEOUT seconds : an idle session does not hold its slot
+			forever. close_poll() ends the sessions still open
+
+		"""
+		writer.transport.set_write_buffer_limits( high = POLL_SESSION_BUFFER )
+		buffer = bytearray(8)	# SecretIDs are only needed as integers
+		n = 0
+		self.sessions.add( writer )
+		try:
+			while not self.closed.is_set() and ( voter_id := await asyncio.wait_for( recv_bytes( reader ), POLL_READ_TIMEOUT ) ):
+				secret = await asyncio.wait_for( recv_into( reader, buffer ), POLL_READ_TIMEOUT )
+				secretID = int.from_bytes( secret )
+				secret.release()
+				answer = await asyncio.wait_for( recv_bytes( reader ), POLL_READ_TIMEOUT )
+
+				verification_key = self.submit_vote(
+						voter_full_id = voter_id,
+						secret = secretID,
+						value = answer,
+					)
+				writer.write( encode_frame( b'' if verification_key is None else int_as_bytes(verification_key) ) )
+				await writer.drain()
+				n += 1
+				if verification_key is None and self.source_quota.take( source ):
+					metrics.POLL_THROTTLED.inc()
+					JOURNAL.warning( 'polling session throttled', source = source )
+					break
+		except (ConnectionError, asyncio.IncompleteReadError, FrameTooLarge, asyncio.TimeoutError) as e:
+			JOURNAL.warning( 'polling session aborted', error = repr(e) )
+		finally:
+			self.sessions.discard( writer )
+			JOURNAL.info( 'polling session closed', submissions = n )
+			writer.close()
+			await writer.wait_closed()
+
 """
 async def main( authority, question, trustees, voters, host ):
 	BMM = await BallotMiddleMan.init( authority, question, trustees, voters, host, ENCODING )
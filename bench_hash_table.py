@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	dictionary-based trust authority : dict vs. hash_table.HashTable
+
+	for a synthetic roll, compares what a trustee does at startup (load its
+	table), how much heap the table takes and how many lookups per second
+	hashfunc() then serves (known and unknown voter IDs, in random order).
+	the table is built once beforehand, that time is reported separately.
+
+	usage: ./bench_hash_table.py [records]
+"""
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from hash_table import HashTable, read_tsv
+
+def load_dict( source ):
+	return dict( read_tsv( source ) )
+
+def startup( load, *args ):
+	tracemalloc.start()
+	start = time.perf_counter()
+	table = load( *args )
+	elapsed = time.perf_counter() - start
+	heap, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return table, elapsed, heap
+
+def lookups( get, keys ):
+	start = time.perf_counter()
+	for key in keys:
+		get( key )
+	return len(keys) / ( time.perf_counter() - start )
+
+if __name__ == '__main__':
+	from sys import argv
+	n = int(argv[1]) if len(argv) > 1 else 1_000_000
+
+	with tempfile.TemporaryDirectory() as directory:
+		source = os.path.join( directory, 'roll.tsv' )
+		with open( source, 'wb' ) as f:
+			f.write( b''.join( b'voter%d\t%032x\n' % (i, random.getrandbits(128)) for i in range(n) ) )
+		path = os.path.join( directory, 'roll.table' )
+		start = time.perf_counter()
+		HashTable.build( path, read_tsv( source ) )
+		print(f"{n} records ; table built in {time.perf_counter()-start:.1f}s ({os.path.getsize(path)/n:.0f} bytes/record on disk)")
+
+		keys = [ b'voter%d' % random.randrange(n) for _ in range(200_000) ] + [ b'nobody%d' % i for i in range(20_000) ]
+		random.shuffle( keys )
+
+		print(f"{'':>10}{'startup s':>12}{'heap MiB':>12}{'lookups/s':>14}")
+		for name, load, arg in (( 'dict', load_dict, source ), ( 'HashTable', HashTable, path )):
+			table, elapsed, heap = startup( load, arg )
+			print(f"{name:>10}{elapsed:>12.3f}{heap/2**20:>12.1f}{lookups( table.get, keys ):>14.0f}")
+			del table
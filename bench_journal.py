@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	per-event cost of the event journal (journal.py) vs. print()
+
+	what the vote path used to do for each accepted vote (a print() and a
+	logging.debug() with its f-string formatted even when DEBUG is off) vs.
+	what it does now, as seen from the event loop : the time spent in the
+	calling thread. print() goes to a line-buffered pipe (like a terminal,
+	every line is a write syscall) drained by another thread.
+
+	usage: ./bench_journal.py [events]
+"""
+import logging
+import os
+import threading
+import time
+
+from journal import Journal, INFO
+
+def pipe():
+	"""
+		a line-buffered pipe, drained in the background ; returns its write end
+	"""
+	r, w = os.pipe()
+	def drain():
+		while os.read( r, 1 << 16 ):
+			pass
+	threading.Thread( target = drain, daemon = True ).start()
+	return open( w, 'w', buffering = 1 )
+
+def timed( f, n ):
+	start = time.perf_counter()
+	f( n )
+	return ( time.perf_counter() - start ) / n
+
+if __name__ == '__main__':
+	from sys import argv
+	n = int(argv[1]) if len(argv) > 1 else 200_000
+
+	out = pipe()
+	logging.basicConfig( level = logging.INFO, stream = out )
+	value = b'42'
+	voter_id = b'voter123' + b'0123456789abcdef'*2
+
+	def old_accepted( n ):
+		for _ in range(n):
+			print(f"+1: {value}", file = out)
+
+	def old_rejected( n ):
+		for _ in range(n):
+			print(f"submit FAIL for {voter_id}: {value}", file = out)
+			logging.debug(f"submit FAIL for {voter_id}: {value}")
+
+	journal = Journal( stream = pipe(), level = INFO )
+	sampled = Journal( stream = pipe(), level = INFO, sample = { 'vote': 100 } )
+
+	def new_accepted( n, journal = journal ):
+		for _ in range(n):
+			journal.info( 'vote', answer = value )
+
+	def new_sampled( n ):
+		new_accepted( n, sampled )
+
+	def new_filtered( n ):
+		for _ in range(n):
+			journal.debug( 'frame received', data = voter_id )
+
+	def new_rejected( n ):
+		for _ in range(n):
+			journal.info( 'vote rejected', voter = voter_id, answer = value )
+
+	print(f"{n} events, ns per event in the calling thread")
+	baseline = None
+	for name, f in (
+			( 'print (accepted vote)', old_accepted ),
+			( 'print + logging.debug (rejected vote)', old_rejected ),
+			( 'journal (accepted vote)', new_accepted ),
+			( 'journal (rejected vote)', new_rejected ),
+			( 'journal, 1 in 100 sampled', new_sampled ),
+			( 'journal, below level', new_filtered ),
+			):
+		cost = timed( f, n )
+		baseline = baseline or cost
+		print(f"{name:<40}{cost*1e9:>10.0f}{cost/baseline:>8.0%}")
+		time.sleep( .5 )	# let the journal threads catch up
+	journal.flush()
+	print(f"dropped by the journal (buffer full): {journal.dropped}")
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	end-to-end load test, on localhost only
+
+	- starts N trust authorities (in this process, or one subprocess each)
+	  with the hash functions of sample_configs/trustee_0.py and trustee_1.py,
+	  each one a replica set of R servers if asked ; with --stragglers, that
+	  share of the answers is delayed by --straggle ms (on a thread of the
+	  trustee, like a slow KDF would be)
+	- writes a synthetic voters list of the requested size
+	- runs a BallotMiddleMan through invite generation, then has voters
+	  submit their votes concurrently the way voter_cli.py does (full ID from
+	  the trustees, invite from PORT_INVITES, vote on PORT_POLLING), then
+	  probes the ballot with verify_vote()
+	- reports throughput, p50/p99 latency and peak RSS for each phase
+
+	usage: ./bench_load.py [--voters N] [--trustees N] [--replicas R] [--turnout F]
+		[--concurrency N] [--probes N] [--stragglers F --straggle MS]
+		[--subprocess] [--verbose]
+
+	peak RSS is the high-water mark of this process at the end of each phase
+	(trust authorities running as subprocesses are not included)
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from shared_funcs import voter_full_id, submit_ballot
+from constants import LISTEN, PORT_POLLING, PORT_INVITES
+from trust_authority import TrustAuthority
+from trustee_pool import TrusteePool
+from invites_client import BallotInvitesClient
+
+TRUSTEE_BASE_PORT = 10100
+
+def trustee_hash( i ):
+	return importlib.import_module(f"sample_configs.trustee_{i % 2}").hash
+
+class Straggler:
+	"""
+		a hash function that is slow once in a while
+	"""
+	def __init__( self, hash, share, delay ):
+		self.hash = hash
+		self.share = share
+		self.delay = delay
+
+	def __call__( self, data ):
+		if random.random() < self.share:
+			time.sleep( self.delay )
+		return self.hash( data )
+
+def trust_authority( i, stragglers = 0, straggle = 0 ):
+	if stragglers:
+		return TrustAuthority( i, f"bench trustee {i}", Straggler( trustee_hash(i), stragglers, straggle/1000 ), executor = 'thread', pool_size = 64 )
+	return TrustAuthority( i, f"bench trustee {i}", trustee_hash(i) )
+
+def serve_trustee( i, host, port, stragglers, straggle ):
+	"""
+		subprocess entry point
+	"""
+	with contextlib.redirect_stdout( open(os.devnull,'w') ):
+		TA = trust_authority( i, stragglers, straggle )
+		asyncio.run( TA.run( host, port ) )
+
+def peak_rss():
+	""" in bytes """
+	return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss * ( 1 if sys.platform == 'darwin' else 1024 )
+
+class Phase:
+	"""
+
+		timings of one phase of the benchmark
+
+	"""
+	def __init__( self, name, unit ):
+		self.name = name
+		self.unit = unit
+		self.latencies = []
+		self.items = 0
+		self.errors = 0
+
+	def __enter__( self ):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__( self, *exc ):
+		self.elapsed = time.perf_counter() - self.start
+		self.rss = peak_rss()
+
+	@contextlib.contextmanager
+	def op( self, items = 1 ):
+		start = time.perf_counter()
+		yield
+		self.latencies.append( time.perf_counter() - start )
+		self.items += items
+
+	def percentile( self, p ):
+		if not self.latencies:
+			return float('nan')
+		l = sorted( self.latencies )
+		return l[ min( len(l)-1, int(p/100*len(l)) ) ]
+
+	def report( self ):
+		return (f"{self.name:<10}{self.items:>10} {self.unit:<8}{self.items/self.elapsed:>12.1f}/s"
+				f"{1000*self.percentile(50):>10.2f}{1000*self.percentile(99):>10.2f}"
+				f"{self.errors:>8}{self.rss/2**20:>10.1f}")
+
+REPORT_HEADER = f"{'phase':<10}{'count':>10} {'':<8}{'throughput':>14}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}{'RSS MiB':>10}"
+
+async def vote( voter_id, trustees, stats, pool, answer ):
+	"""
+		what voter_cli.Voter does, minus the prompts : returns (invite ID,
+		verification key) or None
+	"""
+	full_id = await voter_full_id( voter_id, trustees, stats, (LISTEN, PORT_POLLING), pool )
+	invite = int.from_bytes( await BallotInvitesClient( LISTEN, PORT_INVITES ).get_invite( full_id ), 'big' )
+	verification_key = await submit_ballot( LISTEN, PORT_POLLING, full_id, invite.to_bytes(6,'big'), answer )
+	return (invite, verification_key) if verification_key else None
+
+async def main( args ):
+	from ballotter_core import BallotMiddleMan
+
+	host = LISTEN
+	# (trustee number, (host, port)) for every replica
+	servers = [ (i, (host, TRUSTEE_BASE_PORT + i*args.replicas + r)) for i in range(args.trustees) for r in range(args.replicas) ]
+	processes = []
+	if args.subprocess:
+		for i, (h, port) in servers:
+			p = multiprocessing.Process( target = serve_trustee, args = (i, h, port, args.stragglers, args.straggle), daemon = True )
+			p.start()
+			processes.append( p )
+		await asyncio.sleep(1)
+	else:
+		for i, (h, port) in servers:
+			TA = trust_authority( i, args.stragglers, args.straggle )
+			await asyncio.start_server( TA.trustee_callback, h, port )
+
+	# synthetic voters list, read back the way ballotter.py does
+	with tempfile.NamedTemporaryFile( 'wb', suffix = '.list', delete = False ) as f:
+		f.write( b''.join( b'voter%d\n' % i for i in range(args.voters) ) )
+	voters = [ v.rstrip(b'\n') for v in open(f.name,'rb').readlines() ]
+	os.unlink( f.name )
+	trustees_list = [ b'%s\t%d\tbench%d' % (h.encode(), port, i) for i, (h, port) in servers ]
+
+	phases = []
+	loop = asyncio.get_running_loop()
+
+	with Phase( 'invites', 'voters' ) as phase:
+		with phase.op( len(voters) ):
+			BMM = await BallotMiddleMan.init( loop, b'bench', b'42?', trustees_list, voters, host )
+		await asyncio.sleep(.1)		# let the listeners start
+	phases.append( phase )
+
+	# the voters use (host, port) tuples, like voter_cli does
+	trustees = [ tuple( hp for j, hp in servers if j == i ) for i in range(args.trustees) ]
+	trustees = [ t[0] if len(t) == 1 else t for t in trustees ]
+	stats = { hp: {} for _, hp in servers }
+	pool = TrusteePool( stats )
+	voting = random.sample( voters, int(len(voters)*args.turnout) )
+	slots = asyncio.Semaphore( args.concurrency )
+	receipts = []
+
+	async def one_vote( voter_id ):
+		async with slots:
+			try:
+				with phase.op():
+					receipt = await vote( voter_id, trustees, stats, pool, random.choice((b'yes', b'no', b'42')) )
+			except (OSError, asyncio.IncompleteReadError):
+				receipt = None
+			if receipt is None:
+				phase.errors += 1
+			else:
+				receipts.append( receipt )
+
+	with Phase( 'submit', 'votes' ) as phase:
+		await asyncio.gather(*[ one_vote(v) for v in voting ])
+	phases.append( phase )
+	pool.close()
+
+	# probes : the real receipts mixed with random (invite ID, key) pairs
+	probes = receipts + [ (random.choice(BMM.store.invites), random.getrandbits(47)) for _ in range(args.probes) ]
+	random.shuffle( probes )
+	hits = 0
+	with Phase( 'verify', 'probes' ) as phase:
+		for i in range(0, len(probes), 1000):
+			chunk = probes[i:i+1000]
+			with phase.op( len(chunk) ):
+				for secret, index in chunk:
+					try:
+						BMM.verify_vote( secret, index )
+						hits += 1
+					except KeyError:
+						pass
+			await asyncio.sleep(0)
+	phase.errors = len(receipts) - hits		# every receipt must verify
+	phases.append( phase )
+
+	await asyncio.sleep(.1)		# let the trust authorities see the connections go
+	for p in processes:
+		p.terminate()
+	return phases, BMM
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser( description = "end-to-end load test on localhost" )
+	parser.add_argument( '--voters', type = int, default = 10_000 )
+	parser.add_argument( '--trustees', type = int, default = 2 )
+	parser.add_argument( '--replicas', type = int, default = 1, help = "servers per trustee" )
+	parser.add_argument( '--turnout', type = float, default = .5 )
+	parser.add_argument( '--concurrency', type = int, default = 100, help = "votes submitted at the same time" )
+	parser.add_argument( '--probes', type = int, default = 100_000, help = "random verify_vote() probes" )
+	parser.add_argument( '--stragglers', type = float, default = 0, help = "share of slow trustee answers" )
+	parser.add_argument( '--straggle', type = float, default = 200, help = "how slow, in ms" )
+	parser.add_argument( '--subprocess', action = 'store_true', help = "one process per trust authority" )
+	parser.add_argument( '--verbose', action = 'store_true', help = "keep the servers' output" )
+	args = parser.parse_args()
+
+	out = sys.stdout
+	with contextlib.redirect_stdout( sys.stdout if args.verbose else open(os.devnull,'w') ):
+		phases, BMM = asyncio.run( main( args ) )
+
+	print(f"{args.voters} voters, {args.trustees} trustees{' (subprocesses)' if args.subprocess else ''}"
+			f"{f' x {args.replicas} replicas' if args.replicas > 1 else ''}, concurrency {args.concurrency}"
+			f"{f', {args.stragglers:.0%} of answers {args.straggle:.0f} ms late' if args.stragglers else ''}", file = out)
+	print(REPORT_HEADER, file = out)
+	for phase in phases:
+		print(phase.report(), file = out)
+	print(f"ballot integrity check: {BMM.ballot_integrity_check()}", file = out)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	memory benchmark for the invites/results tables of a BallotMiddleMan
+
+	compares bytes per voter of the original dicts ({full ID: invite} and
+	{secret: answer}) with ballot_store.BallotStore, for a synthetic voters
+	list of which a share has voted. the voters list itself is not counted
+	(both keep it), the full voter IDs are (the dicts keep them as keys).
+	the peak includes the lists of full IDs and invite IDs the tables are
+	built from (more than 100 bytes per voter, whatever the tables)
+
+	'frozen' is the BallotStore once the poll is closed (FrozenBallot) ; the
+	last column is verify() lookups per second, half of them hits (the
+	dicts had no verification keys, they are left out).
+
+	usage: ./bench_memory.py [voters [turnout]]
+"""
+import random
+import time
+import tracemalloc
+from hashlib import md5
+
+from ballot_store import BallotStore
+
+ANSWERS = ( b'yes', b'no', b'42' )
+
+def full_ids( voters ):
+	# what trustee_0 (echo) and trustee_1 (md5) would give
+	return [ v + md5(v).hexdigest().encode() for v in voters ]
+
+def with_dicts( voters, votes ):
+	ids = full_ids( voters )
+	invites = { f: id(v) for f, v in zip(ids, voters) }
+	result = {}
+	for n, f in enumerate(ids[:votes]):
+		secret = invites.pop( f )
+		result[ secret ] = bytes(bytearray(ANSWERS[n % len(ANSWERS)]))	# answers come from the network, one object each
+	return invites, result
+
+def with_store( voters, votes ):
+	ids = full_ids( voters )
+	store = BallotStore( ids, [ id(v) for v in voters ] )
+	for n, f in enumerate(ids[:votes]):
+		store.cast( f, store.invite(f), bytes(bytearray(ANSWERS[n % len(ANSWERS)])) )
+	return store
+
+def with_frozen( voters, votes ):
+	return with_store( voters, votes ).freeze()
+
+def verify_rate( build, voters, votes ):
+	store = build( voters, votes )
+	voted = [ i for i in range(len(store.invites)) if store.vkeys[i] ]
+	probes = [ (store.invites[i], store.vkeys[i]) for i in random.sample( voted, min(votes, 50_000) ) ]
+	probes += [ (s, v+1) for s, v in probes ]	# misses
+	verify = store.verify
+	random.shuffle( probes )
+	start = time.perf_counter()
+	for secret, vkey in probes:
+		try:
+			verify( secret, vkey )
+		except KeyError:
+			pass
+	return len(probes) / ( time.perf_counter() - start )
+
+def measure( build, voters, votes ):
+	tracemalloc.start()
+	tables = build( voters, votes )
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del tables
+	return current, peak
+
+if __name__ == '__main__':
+	from sys import argv
+	n = int(argv[1]) if len(argv) > 1 else 100_000
+	turnout = float(argv[2]) if len(argv) > 2 else .5
+
+	voters = [ b'voter%d' % i for i in range(n) ]
+	votes = int(n*turnout)
+	print(f"{n} voters, {votes} votes cast")
+	print(f"{'':>12}{'bytes/voter':>14}{'peak/voter':>14}{'verify/s':>12}")
+	for name, build in (( 'dicts', with_dicts ), ( 'BallotStore', with_store ), ( 'frozen', with_frozen )):
+		current, peak = measure( build, voters, votes )
+		rate = f"{verify_rate( build, voters, votes ):.0f}" if build is not with_dicts else '-'
+		print(f"{name:>12}{current/n:>14.1f}{peak/n:>14.1f}{rate:>12}")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	cost of an invalid submission (random voter ID), as seen by
+	BallotMiddleMan.submit_vote(), with and without the pre-filter (see
+	prefilter.py) ; also its false positive rate and size
+
+	usage: ./bench_prefilter.py [voters [submissions]]
+"""
+import os
+import time
+
+from ballot_store import BallotStore
+from ballotter_core import BallotMiddleMan
+from journal import JOURNAL
+import metrics
+from bench_memory import full_ids
+
+class Everyone:
+	""" a pre-filter that lets everything through """
+	def __contains__( self, key ):
+		return True
+
+	def discard( self, key ):
+		pass
+
+if __name__ == '__main__':
+	from sys import argv
+	n = int(argv[1]) if len(argv) > 1 else 100_000
+	probes = int(argv[2]) if len(argv) > 2 else 100_000
+
+	voters = [ b'voter%d' % i for i in range(n) ]
+	BMM = BallotMiddleMan( None, b'bench', b'42?', [], voters, None, 'utf-8' )
+	BMM.store = BallotStore( full_ids( voters ), [ id(v) for v in voters ] )
+	start = time.perf_counter()
+	BMM.build_prefilter()
+	print(f"{n} voters ; pre-filter built in {time.perf_counter()-start:.2f}s, {BMM.prefilter.nbytes()/n:.1f} bytes/voter, k = {BMM.prefilter.k}")
+	JOURNAL.stream = open( os.devnull, 'w' )
+
+	garbage = [ os.urandom(40) for _ in range(probes) ]
+	prefilter = BMM.prefilter
+	print(f"{'':>12}{'ns/submission':>16}{'reached the store':>20}")
+	for name, f in (( 'unfiltered', Everyone() ), ( 'pre-filter', prefilter )):
+		BMM.prefilter = f
+		rejected = metrics.VOTES.values.get( ('rejected',), 0 )
+		start = time.perf_counter()
+		for voter_id in garbage:
+			BMM.submit_vote( voter_id, 1, b'42' )
+		elapsed = time.perf_counter() - start
+		reached = metrics.VOTES.values.get( ('rejected',), 0 ) - rejected
+		print(f"{name:>12}{elapsed/probes*1e9:>16.0f}{reached/probes:>20.2%}")
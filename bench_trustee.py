@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	trust authority with a slow hash function (PBKDF2) : hashing on the event
+	loop vs. in a thread or process pool (see trust_authority.HashExecutor)
+
+	a batch-mode client sends the roll while another client pings the
+	trustee (multiplexed mode) ; reports hashes per second and the worst
+	ping round trip, i.e. how long the event loop was unavailable.
+
+	usage: ./bench_trustee.py [voters [iterations [pool size]]]
+"""
+import asyncio
+import contextlib
+import hashlib
+import os
+import time
+
+from constants import LISTEN, TRUSTEE_MUX
+from shared_funcs import voters_full_ids, recv_bytes, encode_frame
+from trust_authority import TrustAuthority
+from journal import JOURNAL, WARNING
+
+PORT = 10200
+ITERATIONS = 10_000
+
+def kdf( data ):
+	return hashlib.pbkdf2_hmac( 'sha256', data, b'bench salt', ITERATIONS ).hex().encode()
+
+async def ping( host, port, stop ):
+	"""
+		worst round trip of a ping on a multiplexed connection, in seconds
+	"""
+	reader, writer = await asyncio.open_connection( host, port )
+	writer.write( TRUSTEE_MUX )
+	worst = 0.
+	while not stop.is_set():
+		start = time.perf_counter()
+		writer.write( encode_frame(b'p') + encode_frame(b'') )
+		await recv_bytes( reader )
+		await recv_bytes( reader )
+		worst = max( worst, time.perf_counter() - start )
+		await asyncio.sleep( .01 )
+	writer.close()
+	return worst
+
+async def run( executor, pool_size, voters, port ):
+	TA = TrustAuthority( 0, 'bench', kdf, executor = executor, pool_size = pool_size )
+	server = await asyncio.start_server( TA.trustee_callback, LISTEN, port )
+	stop = asyncio.Event()
+	pinger = asyncio.create_task( ping( LISTEN, port, stop ) )
+	start = time.perf_counter()
+	full_ids = await voters_full_ids( voters, [(LISTEN, port)], {(LISTEN, port): {}}, None )
+	elapsed = time.perf_counter() - start
+	stop.set()
+	worst = await pinger
+	server.close()
+	if TA.executor is not None:
+		TA.executor.shutdown()
+	assert full_ids is not None and full_ids[-1] == kdf( voters[-1] )
+	return len(voters)/elapsed, worst
+
+if __name__ == '__main__':
+	from sys import argv
+	n = int(argv[1]) if len(argv) > 1 else 2000
+	ITERATIONS = int(argv[2]) if len(argv) > 2 else ITERATIONS
+	pool_size = int(argv[3]) if len(argv) > 3 else None
+	voters = [ b'voter%d' % i for i in range(n) ]
+	JOURNAL.level = WARNING
+
+	print(f"{n} voters, PBKDF2 with {ITERATIONS} iterations, {os.cpu_count()} CPUs")
+	print(f"{'executor':>10}{'hashes/s':>12}{'worst ping ms':>16}")
+	for i, executor in enumerate(( None, 'thread', 'process' )):
+		with contextlib.redirect_stdout( open(os.devnull,'w') ):
+			rate, worst = asyncio.run( run( executor, pool_size, voters, PORT+i ) )
+		print(f"{str(executor):>10}{rate:>12.0f}{1000*worst:>16.1f}")
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	append-only log of the accepted votes, for incremental replication
+
+	every vote cast gets the next sequence number (starting at 1) ; an
+	aggregator remembers the last one it saw and asks for what came after
+	(/changes?since=<seq>), so following many ballot servers costs O(new
+	votes). records are (secret, verification index, answer) : what
+	verify_vote() checks, without the voter.
+
+	the log is three flat arrays (like ballot_store.BallotStore), the
+	answers being stored once ; the response is JSON lines :
+
+		{"seq": 1, "secret": ..., "index": ..., "answer": "<base64>"}
+"""
+import asyncio
+import base64
+from array import array
+
+from constants import CHANGES_CHUNK
+
+class ChangeLog:
+	"""
+
+		the votes of a BallotMiddleMan, in the order they were cast
+
+	"""
+	def __init__( self ):
+		self.secrets = array( 'Q' )
+		self.vkeys = array( 'Q' )
+		self.answer = array( 'I' )
+		self.answers_index = {}		# answer -> index in self.encoded
+		self.encoded = []			# base64 answers, ready for the JSON lines
+
+	def __len__( self ):
+		return len(self.secrets)
+
+	def append( self, secret, vkey, answer ):
+		"""
+			records a vote ; returns its sequence number
+		"""
+		try:
+			a = self.answers_index[answer]
+		except KeyError:
+			a = self.answers_index[answer] = len(self.encoded)
+			self.encoded.append( base64.b64encode(answer).decode() )
+		self.secrets.append( secret )
+		self.vkeys.append( vkey )
+		self.answer.append( a )
+		return len(self.secrets)
+
+	def lines( self, since, until ):
+		"""
+			the records after sequence number `since`, up to `until`
+			included, as JSON lines in chunks of CHANGES_CHUNK records
+		"""
+		secrets, vkeys, answer, encoded = self.secrets, self.vkeys, self.answer, self.encoded
+		for start in range( since, until, CHANGES_CHUNK ):
+			end = min( start + CHANGES_CHUNK, until )
+			yield ''.join([ f'{{"seq": {i+1}, "secret": {secrets[i]}, "index": {vkeys[i]}, "answer": "{encoded[answer[i]]}"}}\n'
+					for i in range( start, end ) ]).encode()
+
+	def stream( self, since ):
+		"""
+			(body, headers) for the records after `since` that exist now :
+			the body is an async generator, X-Last-Seq is where the next
+			request should start from
+		"""
+		since = min( max( since, 0 ), len(self) )
+		until = len(self)
+
+		async def body():
+			for chunk in self.lines( since, until ):
+				yield chunk
+				await asyncio.sleep(0)
+
+		return body(), { 'Content-Type': 'application/x-ndjson', 'X-Last-Seq': str(until) }
@@ -1,4 +1,5 @@
-MAX_MESSAGE_LEN = 32
+# largest frame (see shared_funcs.send_bytes) or single trustee request accepted
+MAX_FRAME_LEN = 1 << 20
 # Whether we're in debug mode (True) or not (False)
 DEBUG_ENABLED = False
 ENCODING = 'utf-8'
@@ -10,7 +11,134 @@ PORT_HTTP = 8000    # TODO hypercorn/quart does not use this value when it shoul
 
 # where is this poll happening
 TIMEZONE = 'Europe/Zurich'
+# the poll is closed (see BallotMiddleMan.close_poll) when poll_closes is
+# reached ; the scheduler checks the clock at least this often (seconds)
+POLL_CLOSE_CHECK = 60
 
 INVITE_ERROR_INT = 1
 
+# session mode on PORT_POLLING (polling stations, bulk import) : a connection
+# whose first frame is POLL_SESSION carries any number of pipelined
+# (voter ID, SecretID, answer) submissions ; see kiosk_client.py
+POLL_SESSION = b'\x00session'
+POLL_SESSION_WINDOW = 1024		# submissions a client may have in flight
+POLL_SESSION_BUFFER = 1 << 18	# bytes buffered per direction before applying backpressure
+
+# admission control on PORT_POLLING : at most POLL_MAX_INFLIGHT connections are
+# served at once, up to POLL_MAX_QUEUE more wait for a slot for at most
+# POLL_QUEUE_DEADLINE seconds ; the others get a "busy" frame instead of a
+# verification key : POLL_BUSY followed by how many ms to wait before retrying
+# (4 bytes). verification keys never start with a NUL byte.
+POLL_MAX_INFLIGHT = 1024
+POLL_MAX_QUEUE = 4096
+POLL_QUEUE_DEADLINE = 2
+POLL_READ_TIMEOUT = 10			# seconds a client has to send its submission
+POLL_BUSY = b'\x00'
+POLL_BUSY_RETRY = 500			# ms, suggested to busy clients (more when the queue is long)
+# clients retry busy or refused submissions with jittered exponential backoff
+SUBMIT_RETRIES = 6
+SUBMIT_RETRY_DELAY = .25
+SUBMIT_RETRY_MAX = 30
+
+# trust authorities are queried concurrently ; each one gets this many seconds
+# per attempt and is retried (with exponential backoff) a few times before
+# being reported as unresponsive
+TRUSTEE_TIMEOUT = 5
+TRUSTEE_RETRIES = 3
+TRUSTEE_RETRY_DELAY = .1
+
+# batch mode : a connection starting with this byte carries framed voter IDs
+# (see send_bytes) terminated by an empty frame ; framed hashes are streamed
+# back in the same order. voter IDs never start with a NUL byte.
+TRUSTEE_BATCH = b'\x00'
+TRUSTEE_BATCH_SIZE = 1024		# voter IDs per batch connection
+TRUSTEE_BATCH_TIMEOUT = 30		# seconds per batch attempt
+TRUSTEE_BATCH_CONCURRENCY = 4	# batches in flight per trustee (at startup)
+
+# multiplexed mode : a connection starting with this byte carries any number
+# of (request id, voter ID) frame pairs and gets (request id, hash) pairs back ;
+# an empty voter ID is a ping. see trustee_pool.py
+TRUSTEE_MUX = b'\x01'
+TRUSTEE_POOL_SIZE = 2			# long-lived connections per trustee
+TRUSTEE_PING_INTERVAL = 10		# seconds between health checks
+
+# trust authorities with a slow hash function (a KDF) can run it in a thread
+# or process pool (see trust_authority.HashExecutor) : requests queued while
+# the workers are busy are handed over up to this many at a time
+TRUSTEE_EXECUTOR_BATCH = 64
+
+# trust_authority.py --workers N : seconds between two reports of the requests
+# served by all workers
+TRUSTEE_STATS_INTERVAL = 10
+# seconds a worker has to stop (and stop its executor) before it is killed
+TRUSTEE_WORKER_STOP = 5
+
+# replica sets : consecutive lines of trustees.list with the same alias are
+# replicas of one trust authority. a lookup goes to the first replica ; when
+# it takes longer than the TRUSTEE_HEDGE_PERCENTILE of the last
+# TRUSTEE_HEDGE_WINDOW lookups (TRUSTEE_HEDGE_DELAY until there are enough of
+# them), a hedged request goes to the next replica and the first answer wins.
+# when both answer they must agree, and one lookup in TRUSTEE_AUDIT_SAMPLE is
+# sent to two replicas just to check that
+TRUSTEE_HEDGE_PERCENTILE = 95
+TRUSTEE_HEDGE_WINDOW = 1024
+TRUSTEE_HEDGE_DELAY = .05
+TRUSTEE_AUDIT_SAMPLE = 1000
+
+# batch verification (the statistical "brute-force" audit, see /verify) : probes
+# per request, probes verified between two yields to the event loop, and the
+# per-client quota (probes per second, and how many may be spent at once)
+VERIFY_MAX_PROBES = 1 << 20
+VERIFY_CHUNK = 4096
+PROBE_RATE = 50_000
+PROBE_BURST = 1 << 20
+# once the poll is closed, the results are published to VERIFY_SNAPSHOT and
+# verification can be served by VERIFY_WORKERS processes (see verifier.py) ;
+# {port} is the polling port, one file per ballot server on the host
+VERIFY_SNAPSHOT = 'results-{port}.snapshot'
+PORT_VERIFY = 8001
+VERIFY_WORKERS = 4
+# the public voters list (/voters/, see voter_roll.py) : voters per page and
+# gzip level of the precomputed pages
+ROLL_CHUNK = 10_000
+ROLL_COMPRESSLEVEL = 6
+# live feed on the /ws WebSocket (see live_feed.py) : seconds between two
+# frames at most, frames waiting for a subscriber before it is dropped
+LIVE_FEED_INTERVAL = .5
+LIVE_FEED_QUEUE = 16
+# records per chunk of a /changes response (see change_log.py)
+CHANGES_CHUNK = 4096
+# the ballot process publishes its public state (config, trustees, progress,
+# results when allowed...) to STATS_SNAPSHOT every STATS_SNAPSHOT_INTERVAL
+# seconds and on each phase change ; dashboard.py serves the HTTP pages from
+# it with DASHBOARD_WORKERS processes. a tmpfs path keeps it in memory (any
+# path works, e.g. where there is no /dev/shm) ; {port} is the polling port,
+# one file per ballot server on the host. a snapshot older than
+# STATS_SNAPSHOT_STALE seconds is from a ballot process that is gone
+STATS_SNAPSHOT = '/dev/shm/e2v_stats_{port}'
+STATS_SNAPSHOT_INTERVAL = 1
+STATS_SNAPSHOT_STALE = 5 * STATS_SNAPSHOT_INTERVAL
+PORT_DASHBOARD = 8002
+DASHBOARD_WORKERS = 4
+
+# event journal (see journal.py) : lowest level written (DEBUG, INFO, WARNING,
+# ERROR), event kinds of which only one in N is kept, events buffered at most
+# and seconds between two writes
+JOURNAL_LEVEL = 'DEBUG' if DEBUG_ENABLED else 'INFO'
+JOURNAL_SAMPLE = {}				# e.g. { 'vote': 100 }
+JOURNAL_BUFFER = 100_000
+JOURNAL_FLUSH_INTERVAL = .1
+
+# startup : seconds between two progress reports while generating invites
+STARTUP_PROGRESS_INTERVAL = 1
+
+# invalid submissions on PORT_POLLING : a Bloom filter over the voters who
+# may still vote drops most of them before the ballot store is looked at
+# (see prefilter.py), and each source IP gets POLL_SOURCE_RATE tokens per
+# second (POLL_SOURCE_BURST at most) ; every rejected submission takes one,
+# and a source out of tokens is disconnected right away
+PREFILTER_FP_RATE = .01
+POLL_SOURCE_RATE = 10
+POLL_SOURCE_BURST = 100
+
 DATETIME_FMT = '%Y-%m-%dT%H:%M:%S.%f%z'
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	the public HTTP pages of a ballot server, served from its stats snapshot
+
+	the ballot process publishes its public state to STATS_SNAPSHOT (see
+	BallotMiddleMan.publish_stats and stats_snapshot.py) ; this app renders
+	index.html, /config.json, /trustees.json, /ready and /health from it, so
+	page views are served by as many processes as needed and never compete
+	with vote intake :
+
+		./dashboard.py [--workers N] [--bind host:port] [--poll-port PORT]
+
+	or with hypercorn itself : hypercorn --workers N 'dashboard:serve(PORT)'
+	(dashboard:app for PORT_POLLING)
+
+	a snapshot nobody published to for STATS_SNAPSHOT_STALE seconds is from
+	a ballot process that is gone : /ready and /health answer 503 (with
+	"stale", its age) and the file is opened again in case a new ballot
+	process publishes to a new one
+"""
+import base64
+import json
+from collections import Counter
+
+from quart import Quart, render_template, request
+
+from shared_funcs import enc, dec
+from stats_snapshot import SharedSnapshot
+from http_cache import CachedDocument
+from constants import LISTEN, PORT_POLLING, STATS_SNAPSHOT, STATS_SNAPSHOT_STALE, PORT_DASHBOARD, DASHBOARD_WORKERS
+
+app = Quart(__name__)
+app.snapshot_path = STATS_SNAPSHOT.format( port = PORT_POLLING )
+app.snapshot = None
+app.state = app.view = None
+
+def serve( poll_port ):
+	"""
+		the app, for the ballot server polling on `poll_port`
+	"""
+	app.snapshot_path = STATS_SNAPSHOT.format( port = poll_port )
+	return app
+
+class PublicState:
+	"""
+
+		a published BallotMiddleMan.public_state(), with what index.html
+		uses of a BallotMiddleMan
+
+	"""
+	def __init__( self, state ):
+		self.state = state
+		self.phase = state['phase']
+		self.authority = enc(state['authority'])
+		self.question = enc(state['question'])
+		self.poll_opens = state['poll_opens']
+		self.poll_closes = state['poll_closes']
+		self.anticipated_results = state['anticipated_results']
+		self.voters = range( state['voters'] )		# only its len() is shown
+		# the JSON documents, with their ETags, once per version of the snapshot
+		self.config = CachedDocument( state['config'] ) if state['config'] is not None else None
+		self.trustees = CachedDocument( state['trustees'] )
+
+	def startup_progress( self ):
+		return self.state['progress']
+
+	def concatenate_votes( self ):
+		if self.state['results'] is None:
+			return "Results are not available at the moment"
+		return Counter({ base64.b64decode(a): n for a, n in self.state['results'].items() })
+
+	def votes_count( self ):
+		return self.state['votes']
+
+	def poll_progress( self ):
+		return self.state['poll_progress']
+
+	def vote_frequency( self ):
+		return self.state['vote_frequency']
+
+def public_state():
+	"""
+		the latest published state, None if the ballot process did not
+		publish yet (or stopped, removing its snapshot)
+	"""
+	if app.snapshot is not None and ( age := app.snapshot.age() ) is not None and age > STATS_SNAPSHOT_STALE:
+		# nobody publishes to this one anymore
+		app.snapshot.close()
+		app.snapshot = None
+	if app.snapshot is None:
+		try:
+			app.snapshot = SharedSnapshot( app.snapshot_path )
+		except FileNotFoundError:
+			return None
+	state = app.snapshot.read()
+	if state is None:
+		return None
+	# one PublicState per version of the snapshot
+	if app.state is not state:
+		app.state, app.view = state, PublicState( state )
+	return app.view
+
+def stale():
+	"""
+		how long ago the state was published if it is stale, else None
+	"""
+	age = app.snapshot.age()
+	return round( age, 1 ) if age > STATS_SNAPSHOT_STALE else None
+
+NOT_PUBLISHED = "the ballot server has not published its state yet", 503, {"Retry-After": "10"}
+
+@app.route("/")
+async def index():
+	if ( BMM := public_state() ) is None:
+		return NOT_PUBLISHED
+	return await render_template("index.html",
+			BMM = BMM,
+			dec = dec,
+			enc = enc,
+			len = len,
+			round = round,
+		)
+
+@app.route("/config.json")
+async def json_api():
+	if ( BMM := public_state() ) is None:
+		return NOT_PUBLISHED
+	if BMM.phase != 'ready':
+		return json.dumps( BMM.startup_progress() ), 503, {"Retry-After": "10"}
+	return BMM.config.send( request )
+
+@app.route("/trustees.json")
+async def trustees_api():
+	if ( BMM := public_state() ) is None:
+		return NOT_PUBLISHED
+	return BMM.trustees.send( request )
+
+@app.route("/health")
+async def health_api():
+	if ( BMM := public_state() ) is None:
+		return NOT_PUBLISHED
+	progress = dict( BMM.startup_progress(), loop_lag = BMM.state['loop_lag'], integrity = BMM.state['integrity'] )
+	if ( age := stale() ) is not None:
+		return json.dumps( dict( progress, stale = age ) ), 503, {"Content-Type": "application/json"}
+	return json.dumps( progress ), 503 if BMM.phase == 'failed' else 200, {"Content-Type": "application/json"}
+
+@app.route("/ready")
+async def ready_api():
+	if ( BMM := public_state() ) is None:
+		return NOT_PUBLISHED
+	if ( age := stale() ) is not None:
+		return json.dumps( dict( BMM.startup_progress(), stale = age ) ), 503, {"Content-Type": "application/json"}
+	return json.dumps( BMM.startup_progress() ), 200 if BMM.phase == 'ready' else 503, {"Content-Type": "application/json"}
+
+if __name__ == '__main__':
+	import argparse
+	from hypercorn.config import Config
+	from hypercorn.run import run
+	parser = argparse.ArgumentParser( description = "public HTTP pages of a ballot server, from its stats snapshot" )
+	parser.add_argument( '--workers', type = int, default = DASHBOARD_WORKERS, help = "HTTP worker processes" )
+	parser.add_argument( '--bind', default = f"{LISTEN}:{PORT_DASHBOARD}" )
+	parser.add_argument( '--poll-port', type = int, default = PORT_POLLING, help = "polling port of the ballot server" )
+	args = parser.parse_args()
+
+	config = Config()
+	config.application_path = f'dashboard:serve({args.poll_port})'
+	config.bind = [ args.bind ]
+	config.workers = args.workers
+	raise SystemExit( run( config ) )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	on-disk hash table for dictionary-based trust authorities
+
+	a trustee serving a large roll from a dict (see sample_configs/trustee_2.py)
+	has to load millions of objects at startup ; instead, the table is built
+	once into a file and served from an mmap : opening it is instant, lookups
+	only touch a couple of pages, and those are shared with the page cache
+	rather than the process' heap.
+
+	layout (all integers little-endian) :
+
+		MAGIC, number of slots (power of two), number of records
+		slots : (64-bit hash of the voter ID | 1, offset of the record) ;
+		        open addressing with linear probing, 0 is an empty slot
+		records : voter ID length (32 bits), hash length (32 bits), voter ID, hash
+
+	building from a tab-separated file (<voter ID>\t<hash> per line) :
+
+		./hash_table.py <source.tsv> <table>
+
+	and in a trustee config :
+
+		hash = HashTable( 'trustee.table' )
+"""
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from hashlib import blake2b
+
+MAGIC = b'E2VHT\x00\x00\x01'
+HEADER = struct.Struct( '<8sQQ' )
+SLOT = struct.Struct( '<QQ' )
+RECORD = struct.Struct( '<II' )
+
+def key_hash( key ):
+	return int.from_bytes( blake2b( key, digest_size = 8 ).digest(), 'little' ) | 1
+
+class HashTable:
+	"""
+
+		read-only {voter ID: hash} mapping backed by a file built with build()
+
+	"""
+	def __init__( self, path ):
+		self.path = path
+		with open( path, 'rb' ) as f:
+			self.mm = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_READ )
+		magic, self.slots, self.records = HEADER.unpack_from( self.mm )
+		if magic != MAGIC:
+			raise ValueError(f"{path} is not a hash table")
+		self.mask = self.slots - 1
+
+	def get( self, key, default = None ):
+		h = key_hash( key )
+		mm = self.mm
+		i = h & self.mask
+		while True:
+			slot_hash, offset = SLOT.unpack_from( mm, HEADER.size + SLOT.size*i )
+			if slot_hash == h:
+				klen, vlen = RECORD.unpack_from( mm, offset )
+				offset += RECORD.size
+				if mm[offset:offset+klen] == key:
+					return mm[offset+klen:offset+klen+vlen]
+			elif not slot_hash:
+				return default
+			i = (i+1) & self.mask
+
+	def __reduce__( self ):
+		# a process pool (see trust_authority.HashExecutor) re-opens the file
+		return HashTable, ( self.path, )
+
+	def __len__( self ):
+		return self.records
+
+	def close( self ):
+		self.mm.close()
+
+	@staticmethod
+	def build( path, items ):
+		"""
+			writes the table for the (voter ID, hash) pairs of `items` (any
+			iterable, read once) to `path` ; raises ValueError on a duplicate
+			voter ID. memory use is 16 bytes per record plus the slots.
+		"""
+		directory = os.path.dirname( os.path.abspath(path) )
+		hashes, offsets = array('Q'), array('Q')
+		with tempfile.TemporaryFile( dir = directory ) as records:
+			size = 0
+			for key, value in items:
+				hashes.append( key_hash(key) )
+				offsets.append( size )
+				records.write( RECORD.pack( len(key), len(value) ) + key + value )
+				size += RECORD.size + len(key) + len(value)
+			records.flush()
+
+			n = len(hashes)
+			slots = 1 << max( 1, (2*n-1).bit_length() )		# at most half full
+			base = HEADER.size + SLOT.size*slots
+			table = array('Q', bytes(2*8*slots))
+			if table.itemsize != 8:
+				raise RuntimeError("array('Q') is not 64 bits on this platform")
+			view = mmap.mmap( records.fileno(), 0, access = mmap.ACCESS_READ ) if size else b''
+
+			def key_at( offset ):
+				klen, _ = RECORD.unpack_from( view, offset )
+				return view[ offset+RECORD.size : offset+RECORD.size+klen ]
+
+			for h, offset in zip( hashes, offsets ):
+				i = h & (slots-1)
+				while table[2*i]:
+					if table[2*i] == h and key_at( table[2*i+1]-base ) == key_at( offset ):
+						raise ValueError(f"duplicate voter ID {key_at(offset)!r}")
+					i = (i+1) & (slots-1)
+				table[2*i], table[2*i+1] = h, base + offset
+			del hashes, offsets
+
+			if sys.byteorder == 'big':
+				table.byteswap()
+			tmp = path + '.tmp'
+			with open( tmp, 'wb' ) as f:
+				f.write( HEADER.pack( MAGIC, slots, n ) )
+				table.tofile( f )
+				if size:
+					view.close()
+				records.seek(0)
+				while ( chunk := records.read( 1 << 20 ) ):
+					f.write( chunk )
+			os.replace( tmp, path )
+
+def read_tsv( filename ):
+	with open( filename, 'rb' ) as f:
+		for line in f:
+			key, value = line.rstrip(b'\n').split(b'\t',1)
+			yield key, value
+
+if __name__ == '__main__':
+	from sys import argv
+	try:
+		source, path = argv[1], argv[2]
+	except IndexError:
+		print(f"usage: {argv[0]} <source.tsv> <table>")
+		raise SystemExit
+
+	HashTable.build( path, read_tsv( source ) )
+	print(f"{path}: {len(HashTable(path))} records")
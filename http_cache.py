@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	documents serialized once, served many times
+
+	a CachedDocument holds the body of a JSON document, its gzip'd version
+	and a strong ETag ; send() answers a request for it with 304 Not Modified
+	when the client has it already (If-None-Match), gzip'd when the client
+	accepts it, and as is otherwise. clients that poll (voter_cli.py,
+	aggregators) then cost a header comparison per request.
+"""
+import gzip
+from hashlib import blake2b
+
+class CachedDocument:
+	"""
+
+		`body` is a str or bytes ; `key` is whatever the document was built
+		from, so the owner can tell when to build it again (see fresh()) ;
+		`gzipped` is the compressed body if the owner has it already, and
+		`headers` more headers to send with it
+
+	"""
+	def __init__( self, body, key = None, content_type = 'application/json', gzipped = None, headers = None ):
+		self.body = body.encode() if isinstance( body, str ) else body
+		self.key = key
+		self.etag = '"' + blake2b( self.body, digest_size = 16 ).hexdigest() + '"'
+		compressed = gzipped or gzip.compress( self.body, 9, mtime = 0 )
+		self.gzipped = compressed if len(compressed) < len(self.body) else None	# tiny documents do not shrink
+		self.headers = { 'Content-Type': content_type, 'ETag': self.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding', **(headers or {}) }
+		# another representation, so another (strong) ETag
+		self.gzip_etag = self.etag[:-1] + '-gzip"'
+		self.gzip_headers = dict( self.headers, **{ 'ETag': self.gzip_etag, 'Content-Encoding': 'gzip' } )
+
+	def fresh( self, key ):
+		return self.key == key
+
+	def send( self, request ):
+		"""
+			the response to `request` (a Quart request), as (body, status, headers)
+		"""
+		if ( tags := request.headers.get('If-None-Match') ) is not None:
+			tags = [ t.strip() for t in tags.split(',') ]
+			if '*' in tags or self.etag in tags:
+				return b'', 304, self.headers
+			if self.gzip_etag in tags:
+				return b'', 304, self.gzip_headers
+		if self.gzipped is not None and accepts_gzip( request.headers.get('Accept-Encoding', '') ):
+			return self.gzipped, 200, self.gzip_headers
+		return self.body, 200, self.headers
+
+def accepts_gzip( accept_encoding ):
+	for coding in accept_encoding.split(','):
+		name, _, params = coding.partition(';')
+		if name.strip().lower() in ( 'gzip', '*' ):
+			return params.replace(' ','') not in ( 'q=0', 'q=0.0', 'q=0.00', 'q=0.000' )
+	return False
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	non-blocking event journal
+
+	print() on the vote and hash paths blocks the event loop whenever stdout
+	is slow (a terminal, a pipe nobody reads fast enough...). events are
+	instead appended to an in-memory buffer and a background thread formats
+	and writes them ; recording an event is a level check, an optional
+	sampling check and a deque append (see bench_journal.py). the thread
+	writes every JOURNAL_FLUSH_INTERVAL seconds, or as soon as the buffer is
+	half full, and a last time at exit (close()).
+
+	JOURNAL is the instance shared by all components :
+
+		JOURNAL.info( 'vote', answer = value )
+		JOURNAL.debug( 'frame received', data = data )
+
+	events below JOURNAL_LEVEL are dropped right away ; JOURNAL_SAMPLE maps
+	an event kind to N to keep only one such event in N. when the buffer is
+	full, new events are dropped (and counted) rather than blocking.
+"""
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from constants import JOURNAL_LEVEL, JOURNAL_SAMPLE, JOURNAL_BUFFER, JOURNAL_FLUSH_INTERVAL
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = { DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR' }
+
+class Journal:
+	"""
+
+		structured events, buffered in memory and written by a thread
+
+	"""
+	def __init__( self, stream = None, level = INFO, sample = None, maxlen = JOURNAL_BUFFER, flush_interval = JOURNAL_FLUSH_INTERVAL ):
+		self.stream = stream		# None : whatever sys.stdout is when writing
+		self.level = level
+		self.sample = dict(sample or {})	# kind -> keep 1 in N
+		self.seen = {}						# kind -> events seen, for sampling
+		self.maxlen = maxlen
+		self.flush_interval = flush_interval
+		self.buffer = deque()
+		self.dropped = 0
+		self.wakeup = threading.Event()		# set to write right away
+		self.closing = False
+		self.thread = None
+		os.register_at_fork( after_in_child = self.forked )
+
+	def start( self ):
+		if self.thread is None:
+			self.thread = threading.Thread( target = self.writer, name = 'journal', daemon = True )
+			self.thread.start()
+			atexit.register( self.close )
+
+	def forked( self ):
+		# the writer thread does not survive a fork (see trust_authority.serve_workers)
+		self.thread = None
+		self.wakeup = threading.Event()
+
+	def event( self, level, kind, **fields ):
+		if level >= self.level:
+			self.record( level, kind, fields )
+
+	def record( self, level, kind, fields ):
+		if kind in self.sample:
+			n = self.seen.get(kind, 0)
+			self.seen[kind] = n + 1
+			if n % self.sample[kind]:
+				return
+		if len(self.buffer) >= self.maxlen:
+			self.dropped += 1
+			return
+		self.buffer.append(( time.time(), level, kind, fields ))
+		if self.thread is None:
+			self.start()
+		elif len(self.buffer) >= self.maxlen // 2 and not self.wakeup.is_set():
+			self.wakeup.set()		# better written now than dropped later
+
+	# the level is checked before anything else is done : events below it
+	# cost a method call
+	def debug( self, kind, **fields ):
+		if DEBUG >= self.level:
+			self.record( DEBUG, kind, fields )
+
+	def info( self, kind, **fields ):
+		if INFO >= self.level:
+			self.record( INFO, kind, fields )
+
+	def warning( self, kind, **fields ):
+		if WARNING >= self.level:
+			self.record( WARNING, kind, fields )
+
+	def error( self, kind, **fields ):
+		if ERROR >= self.level:
+			self.record( ERROR, kind, fields )
+
+	@staticmethod
+	def format( stamp, level, kind, fields ):
+		return ' '.join([ time.strftime('%H:%M:%S', time.localtime(stamp)) + f".{int(stamp*1000)%1000:03d}", LEVEL_NAMES.get(level, str(level)), kind ]
+				+ [ f"{k}={v}" for k, v in fields.items() ])
+
+	def flush( self ):
+		"""
+			formats and writes whatever is buffered (called by the thread)
+		"""
+		lines = []
+		try:
+			while True:
+				lines.append( self.format( *self.buffer.popleft() ) )
+		except IndexError:
+			pass
+		if self.dropped:
+			lines.append( f"journal: {self.dropped} events dropped (buffer full)" )
+			self.dropped = 0
+		if lines:
+			stream = self.stream or sys.stdout
+			stream.write( '\n'.join(lines) + '\n' )
+			stream.flush()
+
+	def writer( self ):
+		while not self.closing:
+			self.wakeup.wait( self.flush_interval )
+			self.wakeup.clear()
+			try:
+				self.flush()
+			except Exception as e:		# the journal must never take the process down
+				sys.stderr.write( f"journal: cannot write events: {e!r}\n" )
+
+	def close( self ):
+		"""
+			stops the thread (without waiting for the end of its interval)
+			and writes what is left
+		"""
+		self.closing = True
+		self.wakeup.set()
+		if self.thread is not None and self.thread is not threading.current_thread():
+			self.thread.join()
+		self.flush()
+
+JOURNAL = Journal( level = { 'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING, 'ERROR': ERROR }[JOURNAL_LEVEL], sample = JOURNAL_SAMPLE )
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	polling station / bulk-import client
+
+	submits many votes over a single connection to PORT_POLLING, using the
+	ballot server's session mode : submissions are pipelined (up to
+	POLL_SESSION_WINDOW of them waiting for their verification key) and the
+	keys come back in order.
+"""
+import asyncio
+
+from shared_funcs import send_bytes, recv_length, encode_frame, dec, check_busy, with_retries
+from constants import LISTEN, PORT_POLLING, POLL_SESSION, POLL_SESSION_WINDOW, SUBMIT_RETRIES
+
+class PollingSession:
+	"""
+
+		a session-mode connection to a ballot server
+
+	"""
+	def __init__( self, host, port = PORT_POLLING, window = POLL_SESSION_WINDOW ):
+		self.host = (host, port)
+		self.window = window
+
+	async def submit_many( self, ballots, retries = SUBMIT_RETRIES ):
+		"""
+			ballots is an iterable of (full voter ID, SecretID as bytes, answer)
+			; returns the verification keys in the same order (None where the
+			vote was not cast)
+
+			a busy server turns the session away before reading any ballot : the
+			session is retried like single submissions (see
+			shared_funcs.with_retries). a session that breaks later is not, some
+			of its votes were cast already
+		"""
+		ballots = list(ballots)
+		return await with_retries( lambda: self.session( ballots ), *self.host, retries, errors = ConnectionRefusedError )
+
+	async def session( self, ballots ):
+		""" one attempt at submit_many() """
+		reader, writer = await asyncio.open_connection( *self.host )
+		slots = asyncio.Semaphore( self.window )
+
+		async def feed():
+			await send_bytes( writer, POLL_SESSION )
+			for voter_id, secret_id, answer in ballots:
+				await slots.acquire()
+				writer.write( encode_frame(voter_id) + encode_frame(secret_id) + encode_frame(answer) )
+				await writer.drain()
+			writer.write_eof()
+
+		feeder = asyncio.create_task( feed() )
+		try:
+			keys = []
+			for _ in ballots:
+				bytelen = await recv_length( reader )
+				if bytelen is None:
+					raise ConnectionResetError(f"ballot server closed the session after {len(keys)} submissions")
+				data = await reader.readexactly(bytelen)
+				check_busy( data )		# the server had no slot for this session
+				keys.append( int.from_bytes(data,'big') or None )
+				slots.release()
+			await feeder
+			return keys
+		finally:
+			feeder.cancel()
+			writer.close()
+			await writer.wait_closed()
+
+async def main( host, port, filename ):
+	"""
+		each line of `filename` is a submission : <full voter ID>\t<SecretID (hex)>\t<answer>
+	"""
+	ballots = []
+	for line in open(filename,'rb').read().splitlines():
+		voter_id, secret_id, answer = line.split(b'\t',2)
+		ballots.append(( voter_id, int(secret_id,0).to_bytes(6,'big'), answer ))
+
+	keys = await PollingSession( host, port ).submit_many( ballots )
+	for (voter_id, secret_id, answer), key in zip(ballots, keys):
+		if key is None:
+			print(f"FAILED\t{dec(voter_id)}\t{dec(answer)}")
+		else:
+			print(f"{hex(key)}\t{dec(voter_id)}\t{dec(answer)}")
+	print(f"{sum(k is not None for k in keys)}/{len(ballots)} votes cast")
+
+if __name__ == '__main__':
+	from sys import argv
+	try:
+		filename = argv[1]
+		host, port = argv[2].split(':',1) if len(argv) > 2 else (LISTEN, PORT_POLLING)
+		port = int(port)
+	except (IndexError, ValueError):
+		print(f"usage: {argv[0]} <ballots file> [<host>:<port>]")
+		raise SystemExit
+
+	asyncio.run( main( host, port, filename ) )
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	live turnout (and results, when they may be shown) over WebSockets
+
+	submit_vote() only counts (vote()) ; every LIVE_FEED_INTERVAL seconds, if
+	anything changed, the broadcaster serializes one frame for everyone :
+
+		{"seq": n, "votes": ..., "progress": ..., "closed": ..., "delta": {base64 answer: votes}}
+
+	"delta" only while the results are available (see
+	BallotMiddleMan.results_available) ; when they become available, and in
+	the first frame a subscriber gets, "tally" holds the whole tally instead.
+	a subscriber that has LIVE_FEED_QUEUE frames waiting is too slow : it is
+	dropped rather than buffered for.
+"""
+import asyncio
+import base64
+import json
+from collections import deque, Counter
+
+import metrics
+from shared_funcs import dec
+from constants import LIVE_FEED_INTERVAL, LIVE_FEED_QUEUE
+
+class Subscriber:
+	"""
+
+		frames waiting to be sent to one client
+
+	"""
+	def __init__( self ):
+		self.frames = deque()
+		self.ready = asyncio.Event()
+		self.dropped = False
+
+	def put( self, frame ):
+		self.frames.append( frame )
+		self.ready.set()
+
+	def drop( self ):
+		self.dropped = True
+		self.frames.clear()
+		self.ready.set()
+
+	async def get( self ):
+		"""
+			the next frame, None once dropped
+		"""
+		while not self.frames:
+			if self.dropped:
+				return None
+			self.ready.clear()
+			await self.ready.wait()
+		return self.frames.popleft()
+
+
+def encode_tally( tally ):
+	return { dec(base64.b64encode(answer)): n for answer, n in tally.items() }
+
+class LiveFeed:
+	"""
+
+		the feed of a BallotMiddleMan (`ballot`)
+
+	"""
+	def __init__( self, ballot, interval = LIVE_FEED_INTERVAL, queue = LIVE_FEED_QUEUE ):
+		self.ballot = ballot
+		self.interval = interval
+		self.queue = queue
+		self.subscribers = set()
+		self.pending = Counter()	# answer -> votes since the last frame
+		self.changed = False
+		self.seq = 0
+		self.allowed = False		# were the results available at the last frame
+		metrics.LIVE_SUBSCRIBERS.function = lambda: len(self.subscribers)
+
+	def vote( self, answer ):
+		self.pending[ answer ] += 1
+		self.changed = True
+
+	def state( self, tally = False ):
+		ballot = self.ballot
+		state = { 'seq': self.seq, 'votes': ballot.votes_count(), 'progress': ballot.poll_progress(), 'closed': ballot.closed.is_set() }
+		if tally and ballot.results_available():
+			# as of the last frame : the next one brings self.pending
+			state['tally'] = encode_tally( ballot.concatenate_votes() - self.pending )
+		return state
+
+	def subscribe( self ):
+		"""
+			a new Subscriber, whose first frame is the current state
+		"""
+		subscriber = Subscriber()
+		subscriber.put( json.dumps( self.state( tally = True ) ) )
+		self.subscribers.add( subscriber )
+		return subscriber
+
+	def unsubscribe( self, subscriber ):
+		self.subscribers.discard( subscriber )
+
+	def frame( self ):
+		"""
+			the next frame (serialized), None if nothing changed
+		"""
+		allowed = self.ballot.results_available()
+		if not self.changed and allowed == self.allowed:
+			return None
+		self.seq += 1
+		if allowed and not self.allowed:
+			self.pending.clear()
+			state = self.state( tally = True )
+		else:
+			state = self.state()
+			if allowed:
+				state['delta'] = encode_tally( self.pending )
+		self.pending.clear()		# counted in the tally, or not to be shown
+		self.changed = False
+		self.allowed = allowed
+		return json.dumps( state )
+
+	def broadcast( self, frame ):
+		for subscriber in list(self.subscribers):
+			if len(subscriber.frames) >= self.queue:
+				subscriber.drop()
+				self.subscribers.discard( subscriber )
+				metrics.LIVE_DROPPED.inc()
+			else:
+				subscriber.put( frame )
+
+	async def run( self ):
+		while True:
+			await asyncio.sleep( self.interval )
+			if self.subscribers and ( frame := self.frame() ) is not None:
+				self.broadcast( frame )
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	Prometheus-style metrics, served as text on /metrics (see ballotter.py)
+
+	there is no dependency on a Prometheus client library : updating a metric
+	is a dict lookup and an addition, cheap enough to leave on in production.
+	values are only formatted when /metrics is scraped.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+
+REGISTRY = []
+
+class Metric:
+	kind = None
+
+	def __init__( self, name, help, labels = () ):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.values = {}		# label values tuple -> value
+		REGISTRY.append( self )
+
+	def _labels( self, key ):
+		if not key:
+			return ''
+		return '{' + ','.join( f'{l}="{v}"' for l, v in zip(self.labels, key) ) + '}'
+
+	def samples( self ):
+		for key, value in self.values.items():
+			yield self.name, self._labels(key), value
+
+	def exposition( self ):
+		lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}" ]
+		lines += [ f"{name}{labels} {value}" for name, labels, value in self.samples() ]
+		return '\n'.join(lines)
+
+class Counter(Metric):
+	kind = 'counter'
+
+	def inc( self, *key, n = 1 ):
+		try:
+			self.values[key] += n
+		except KeyError:
+			self.values[key] = n
+
+class Gauge(Metric):
+	"""
+		set() a value, or give a function that is called at scrape time
+	"""
+	kind = 'gauge'
+
+	def __init__( self, name, help, labels = (), function = None ):
+		super().__init__( name, help, labels )
+		self.function = function
+
+	def set( self, value, *key ):
+		self.values[key] = value
+
+	def samples( self ):
+		if self.function is not None:
+			yield self.name, '', self.function()
+		else:
+			yield from super().samples()
+
+class Histogram(Metric):
+	kind = 'histogram'
+	BUCKETS = ( .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10 )
+
+	def __init__( self, name, help, labels = (), buckets = BUCKETS ):
+		super().__init__( name, help, labels )
+		self.buckets = buckets
+
+	def observe( self, value, *key ):
+		try:
+			counts = self.values[key]
+		except KeyError:
+			counts = self.values[key] = [0]*(len(self.buckets)+1) + [0.]	# per bucket (and +Inf), then the sum
+		counts[ bisect_left(self.buckets, value) ] += 1
+		counts[-1] += value
+
+	def samples( self ):
+		for key, counts in self.values.items():
+			labels = self._labels(key)[1:-1]
+			sep = ',' if labels else ''
+			total = 0
+			for bound, n in zip( self.buckets + ('+Inf',), counts ):
+				total += n
+				yield f"{self.name}_bucket", f'{{{labels}{sep}le="{bound}"}}', total
+			yield f"{self.name}_sum", self._labels(key), counts[-1]
+			yield f"{self.name}_count", self._labels(key), total
+
+class Meter:
+	"""
+		events per second over the last `window` seconds (not exported ;
+		used for the "Vote frequency" figure of the dashboard)
+	"""
+	def __init__( self, window = 60 ):
+		self.window = window
+		self.slots = [0]*window
+		self.second = int(time.monotonic())
+
+	def _advance( self, now ):
+		if now - self.second >= self.window:
+			self.slots = [0]*self.window
+		else:
+			for s in range( self.second+1, now+1 ):
+				self.slots[ s % self.window ] = 0
+		self.second = max( self.second, now )
+
+	def mark( self, n = 1 ):
+		now = int(time.monotonic())
+		if now != self.second:
+			self._advance( now )
+		self.slots[ now % self.window ] += n
+
+	def rate( self ):
+		self._advance( int(time.monotonic()) )
+		return sum(self.slots) / self.window
+
+def exposition():
+	return '\n'.join( m.exposition() for m in REGISTRY ) + '\n'
+
+# trust authorities (labelled with host:port)
+TRUSTEE_LATENCY = Histogram( 'e2v_trustee_request_seconds', "trust authority request latency", ('trustee',) )
+TRUSTEE_TIMEOUTS = Counter( 'e2v_trustee_timeouts_total', "trust authority requests that timed out", ('trustee',) )
+TRUSTEE_ERRORS = Counter( 'e2v_trustee_errors_total', "trust authority requests that failed", ('trustee', 'error') )
+TRUSTEE_HEDGED = Counter( 'e2v_trustee_hedged_total', "hedged requests sent to another replica", ('trustee',) )
+TRUSTEE_INCONSISTENT = Counter( 'e2v_trustee_inconsistent_total', "replicas that disagreed with the answer used", ('trustee',) )
+
+# ballot
+VOTES = Counter( 'e2v_votes_total', "vote submissions", ('result',) )
+INVITE_REQUESTS = Counter( 'e2v_invite_requests_total', "invite requests", ('result',) )
+POLL_BUSY = Counter( 'e2v_poll_busy_total', "PORT_POLLING connections told to retry later (no slot)" )
+POLL_INFLIGHT = Gauge( 'e2v_poll_inflight', "PORT_POLLING connections being served" )
+POLL_QUEUED = Gauge( 'e2v_poll_queued', "PORT_POLLING connections waiting for a slot" )
+POLL_THROTTLED = Counter( 'e2v_poll_throttled_total', "PORT_POLLING connections dropped because their source was out of quota" )
+INTEGRITY = Gauge( 'e2v_ballot_integrity', "ballot_integrity_check() ; MUST NOT be positive" )
+
+# live feed
+LIVE_SUBSCRIBERS = Gauge( 'e2v_live_subscribers', "WebSocket live feed subscribers" )
+LIVE_DROPPED = Counter( 'e2v_live_dropped_total', "live feed subscribers dropped for being too slow" )
+
+# event loop
+LOOP_LAG = Gauge( 'e2v_event_loop_lag_seconds', "how late the last event loop lag probe woke up" )
+LOOP_LAG_HISTOGRAM = Histogram( 'e2v_event_loop_lag_probe_seconds', "event loop lag probes" )
+
+async def monitor_loop_lag( interval = .5 ):
+	"""
+		sleeps `interval` seconds over and over ; waking up late means the
+		event loop was busy
+	"""
+	loop = asyncio.get_running_loop()
+	while True:
+		start = loop.time()
+		await asyncio.sleep( interval )
+		lag = max( 0., loop.time() - start - interval )
+		LOOP_LAG.set( lag )
+		LOOP_LAG_HISTOGRAM.observe( lag )
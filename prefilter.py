@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	counting Bloom filter over the full voter IDs that may still vote
+
+	a submission whose voter ID is not in the filter is certainly invalid
+	(unknown voter, or already voted) and is dropped before it reaches the
+	BallotStore ; a false positive (PREFILTER_FP_RATE of the garbage) just
+	takes the normal path. counters (one byte each) rather than bits so voters
+	can be removed once they have voted ; a counter that reached 255 is never
+	decremented again (it stays a possible false positive, nothing worse).
+
+	keys are ballot_store.digest() values : they are uniformly distributed
+	already, so the k positions are derived from them without hashing again.
+"""
+import math
+
+class CountingBloomFilter:
+	"""
+
+		sized for n keys and a false positive rate of fp_rate
+
+	"""
+	def __init__( self, n, fp_rate ):
+		n = max( n, 1 )
+		self.m = math.ceil( -n * math.log(fp_rate) / math.log(2)**2 )
+		self.k = max( 1, round( self.m / n * math.log(2) ) )
+		self.counters = bytearray( self.m )
+
+	def positions( self, key ):
+		# double hashing (Kirsch-Mitzenmacher) with the two halves of the digest
+		h = int.from_bytes( key, 'little' )
+		h1, h2 = h & 0xffffffffffffffff, (h >> 64) | 1
+		m = self.m
+		return [ (h1 + i*h2) % m for i in range(self.k) ]
+
+	def add( self, key ):
+		counters = self.counters
+		for p in self.positions( key ):
+			if counters[p] < 255:
+				counters[p] += 1
+
+	def discard( self, key ):
+		"""
+			removes a key that was added (removing anything else corrupts the filter)
+		"""
+		counters = self.counters
+		for p in self.positions( key ):
+			if counters[p] < 255:
+				counters[p] -= 1
+
+	def __contains__( self, key ):
+		counters = self.counters
+		for p in self.positions( key ):
+			if not counters[p]:
+				return False
+		return True
+
+	def nbytes( self ):
+		return self.m
@@ -5,6 +5,9 @@ conf = {
 	'name': 'Trust Authority One (md5)',
 	'desc': "This trust authority is an md5 dummy ; a good example to implement proprietary hash methods",
 	'serve': ('127.0.0.1', 10001),
+	# a slow hash function (a KDF) should not run on the event loop :
+	#'executor': 'process',		# or 'thread'
+	#'pool_size': 4,			# defaults to the number of CPUs
 }
 
 from hashlib import md5
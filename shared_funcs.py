@@ -3,9 +3,15 @@
 # -*- coding: utf-8 -*-
 # vim: ts=4 noet number nowrap
 import asyncio
+import functools
 import logging
+import random
+import time
+from collections import deque
 
 from constants import *
+import metrics
+from journal import JOURNAL
 
 if DEBUG_ENABLED:
 	logging.basicConfig(level=logging.DEBUG)
@@ -20,7 +26,206 @@ def increment(dic, key, inc = 1):
 		dic[key] = inc
 
 
-async def voter_full_id( voter_name, providers, stats_dict, ballotter ):
+class TokenBucket:
+	"""
+		`rate` tokens per second, at most `burst` of them saved up
+	"""
+	def __init__( self, rate, burst ):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = time.monotonic()
+
+	def take( self, n = 1 ):
+		"""
+			spends n tokens ; if there are not enough, nothing is spent and
+			the number of seconds to wait before retrying is returned
+		"""
+		now = time.monotonic()
+		self.tokens = min( self.burst, self.tokens + (now - self.stamp)*self.rate )
+		self.stamp = now
+		if n <= self.tokens:
+			self.tokens -= n
+			return 0
+		return (n - self.tokens) / self.rate
+
+	def wait( self ):
+		"""
+			seconds before a token is available (0 if there is one), spending nothing
+		"""
+		return self.take( 0 ) or max( 0, (1 - self.tokens) / self.rate )
+
+class RateLimiter:
+	"""
+		one TokenBucket per client ; when there are too many clients, the
+		buckets that have filled up again (idle clients) are forgotten
+	"""
+	def __init__( self, rate, burst, max_clients = 10_000 ):
+		self.rate = rate
+		self.burst = burst
+		self.max_clients = max_clients
+		self.buckets = {}
+
+	def take( self, client, n = 1 ):
+		try:
+			bucket = self.buckets[client]
+		except KeyError:
+			if len(self.buckets) >= self.max_clients:
+				now = time.monotonic()
+				self.buckets = { c: b for c, b in self.buckets.items() if b.tokens + (now - b.stamp)*b.rate < b.burst }
+			bucket = self.buckets[client] = TokenBucket( self.rate, self.burst )
+		return bucket.take( n )
+
+	def wait( self, client ):
+		bucket = self.buckets.get( client )
+		return 0 if bucket is None else bucket.wait()
+
+def trustee_label( host, port ):
+	"""
+		host:port as a str, whether host and port are str/int or bytes
+	"""
+	return ':'.join( x.decode(ENCODING) if isinstance(x, bytes) else str(x) for x in (host, port) )
+
+def replicas( provider ):
+	"""
+		a provider is a trust authority's (host, port), or a tuple of them for
+		a replica set ; returns the tuple of its (host, port)
+	"""
+	return provider if isinstance( provider[0], tuple ) else ( provider, )
+
+def parse_trustees( lines ):
+	"""
+		trustees.list lines (host, port and alias, tab-separated) -> providers
+		(in order) and a STATS dict with an entry per (host, port) ;
+		consecutive lines with the same alias are a replica set
+	"""
+	providers, aliases, stats = [], [], {}
+	for line in lines:
+		endpoint = ( *line.split(b'\t',2)[:2], )
+		alias = line.rsplit(b'\t',1)[-1]
+		stats[endpoint] = {'alias': alias}
+		if aliases and aliases[-1] == alias:
+			providers[-1] = replicas( providers[-1] ) + ( endpoint, )
+		else:
+			providers.append( endpoint )
+			aliases.append( alias )
+	return providers, stats
+
+class LatencyWindow:
+	"""
+		latencies of the last `size` lookups to a replica set ; delay is
+		their `percentile`, after which a lookup is hedged
+	"""
+	def __init__( self, size = TRUSTEE_HEDGE_WINDOW, percentile = TRUSTEE_HEDGE_PERCENTILE ):
+		self.latencies = deque( maxlen = size )
+		self.percentile = percentile
+		self.delay = TRUSTEE_HEDGE_DELAY
+		self.count = 0
+
+	def observe( self, latency ):
+		self.latencies.append( latency )
+		self.count += 1
+		if not self.count % 64 and len(self.latencies) >= 128:		# sorting is not free, only now and then
+			l = sorted( self.latencies )
+			self.delay = l[ min( len(l)-1, int(self.percentile/100*len(l)) ) ]
+
+HEDGE_WINDOWS = {}		# replica set -> LatencyWindow
+_checking = set()		# losing legs of hedged requests, until they are compared
+
+def check_replica( answer, endpoint, other, task ):
+	"""
+		done callback of the losing leg of a hedged request : both replicas
+		must have given the same answer
+	"""
+	_checking.discard( task )
+	if task.cancelled() or task.exception() is not None or task.result() is None:
+		return
+	if task.result() != answer:
+		metrics.TRUSTEE_INCONSISTENT.inc( trustee_label( *other ) )
+		JOURNAL.error( 'replicas disagree', trustee = trustee_label( *endpoint ), replica = trustee_label( *other ) )
+
+async def hedged_request( provider, leg ):
+	"""
+		leg( (host, port) ) is a coroutine returning what that replica
+		answered, or None ; it is awaited for the first replica of the
+		provider, then for the next one too if the first is slower than the
+		provider's LatencyWindow or fails. the first answer wins.
+
+		returns None if no replica answered
+	"""
+	endpoints = list( replicas( provider ) )
+	if len(endpoints) == 1:
+		return await leg( endpoints[0] )
+	try:
+		window = HEDGE_WINDOWS[provider]
+	except KeyError:
+		window = HEDGE_WINDOWS[provider] = LatencyWindow()
+
+	legs = {}		# task -> (host, port)
+	def observe( start, task ):
+		# every replica's latency counts, hedged or not
+		if not task.cancelled() and task.exception() is None and task.result() is not None:
+			window.observe( time.perf_counter() - start )
+
+	def launch():
+		endpoint = endpoints.pop(0)
+		task = asyncio.create_task( leg( endpoint ) )
+		task.add_done_callback( functools.partial( observe, time.perf_counter() ) )
+		legs[task] = endpoint
+
+	launch()
+	if not random.randrange( TRUSTEE_AUDIT_SAMPLE ):
+		launch()
+	try:
+		while legs:
+			done, _ = await asyncio.wait( legs, timeout = window.delay if endpoints else None, return_when = asyncio.FIRST_COMPLETED )
+			if not done:
+				metrics.TRUSTEE_HEDGED.inc( trustee_label( *endpoints[0] ) )
+				launch()
+				continue
+			for task in done:
+				endpoint = legs.pop( task )
+				answer = task.result()
+				if answer is not None:
+					for other, other_endpoint in legs.items():
+						_checking.add( other )
+						other.add_done_callback( functools.partial( check_replica, answer, endpoint, other_endpoint ) )
+					legs = {}
+					return answer
+			if endpoints:		# a replica failed, try the next one right away
+				launch()
+	finally:
+		for task in legs:		# only when cancelled
+			task.cancel()
+
+async def trustee_request( stats, request, *args, timeout = TRUSTEE_TIMEOUT, trustee = None ):
+	"""
+		await `request(*args)` with a timeout, retrying a few times with
+		exponential backoff ; failures are counted in `stats` by exception type
+
+		trustee is the (host, port) the request goes to, for the metrics
+
+		returns None if the trustee never answered
+	"""
+	label = trustee_label( *trustee ) if trustee else ''
+	for attempt in range(TRUSTEE_RETRIES):
+		if attempt:
+			await asyncio.sleep( TRUSTEE_RETRY_DELAY * 2**(attempt-1) )
+		start = time.perf_counter()
+		try:
+			result = await asyncio.wait_for( request( *args ), timeout )
+		except asyncio.TimeoutError as e:
+			metrics.TRUSTEE_TIMEOUTS.inc( label )
+			increment( stats, type(e) )
+		except (OSError, asyncio.IncompleteReadError) as e:
+			# ConnectionRefusedError, ConnectionResetError...
+			metrics.TRUSTEE_ERRORS.inc( label, type(e).__name__ )
+			increment( stats, type(e) )
+		else:
+			metrics.TRUSTEE_LATENCY.observe( time.perf_counter() - start, label )
+			return result
+
+async def voter_full_id( voter_name, providers, stats_dict, ballotter, pool = None ):
 	"""
 		a helper function known by everybody ; simply concatenate hashes IN THE CORRECT ORDER
 
@@ -28,35 +233,120 @@ async def voter_full_id( voter_name, providers, stats_dict, ballotter ):
 
 		balloter is a tuple of the form ( str, int )
 
+		pool is an optional trustee_pool.TrusteePool ; when given, lookups
+		share its long-lived connections instead of opening one each
+
 	"""
+	async def request_hash( voter_name, host, port ):
+		reader, writer = await asyncio.open_connection(host, port)
+		try:
+			writer.write(voter_name)
+			writer.write_eof()
+			await writer.drain()
+
+			data = await reader.read()
+			#print(f'Received from {(host,port)}: {data}')
+			#logging.debug(f'Received from {(host,port)}: {data}')
+			return data
+		finally:
+			writer.close()
+			await writer.wait_closed()
+
 	async def get_hash( voter_name, host, port ):
 		#print(f"get_hash({voter_name}, {host}, {port})")
-		try:
-			reader, writer = await asyncio.open_connection(host, port)
-		except ConnectionRefusedError:
-			# TODO we might want to retry a few times...
-			increment( stats_dict[(host,port)], ConnectionRefusedError )
-		else:
-			try:
-				writer.write(voter_name)
-				await writer.drain()
+		return await trustee_request( stats_dict[(host,port)], request_hash if pool is None else pool.get_hash, voter_name, host, port, trustee = (host,port) )
 
-				data = await reader.read()
-				#print(f'Received from {(host,port)}: {data}')
-				#logging.debug(f'Received from {(host,port)}: {data}')
-				return data
-			finally:
-				writer.close()
-				await writer.wait_closed()
-		
 	#print(f"{providers = }")
-	# TODO make sure this is good async
+	# all trustees are queried at once, so a voter ID costs max(latency) rather
+	# than sum(latency) ; gather() keeps the order of trustees.list
+	hashes = await asyncio.gather(*[ hedged_request( provider, lambda endpoint: get_hash( voter_name, *endpoint ) ) for provider in providers ])
 	try:
-		return b''.join([ await get_hash( voter_name, *provider ) for provider in providers ])
+		return b''.join(hashes)
 	except TypeError:
-		print(f"Warning: some trustee did not respond with hash for voter {voter_name}")
+		JOURNAL.warning( 'some trustee did not respond with hash', voter = voter_name )
 		return None
 
+async def voters_full_ids( voter_names, providers, stats_dict, ballotter, progress = None ):
+	"""
+		voter_full_id() for a whole roll, using the trustees' batch mode : voter
+		IDs are streamed TRUSTEE_BATCH_SIZE at a time on a connection and the
+		hashes are read back in the same order, all trustees concurrently and
+		up to TRUSTEE_BATCH_CONCURRENCY batches in flight per trustee (or replica)
+
+		progress( n ) is called whenever n voters (in total) have been
+		resolved by every trustee
+
+		returns the list of full IDs (in the order of voter_names), or None if
+		some trustee did not respond
+	"""
+	async def request_hashes( voter_names, host, port ):
+		reader, writer = await asyncio.open_connection(host, port)
+		try:
+			async def feed():
+				writer.write(TRUSTEE_BATCH)
+				for voter_name in voter_names:
+					await send_bytes( writer, voter_name )
+				await send_bytes( writer, b'' )
+
+			feeder = asyncio.create_task( feed() )
+			try:
+				hashes = []
+				for voter_name in voter_names:
+					# EOF before a frame means the trustee went away ; an empty
+					# frame is its answer for a voter it does not know
+					if ( length := await recv_length( reader ) ) is None:
+						raise ConnectionResetError(f"no hash from {(host,port)} for {voter_name}")
+					hashes.append( await reader.readexactly( length ) )
+					if not length:
+						JOURNAL.warning( 'unknown voter', trustee = trustee_label( host, port ), voter = voter_name )
+				await feeder
+			finally:
+				feeder.cancel()
+			return hashes
+		finally:
+			writer.close()
+			await writer.wait_closed()
+
+	starts = range(0, len(voter_names), TRUSTEE_BATCH_SIZE)
+	waiting = { i: len(providers) for i in starts }	# batch -> trustees yet to answer it
+	resolved = 0
+
+	def batch_done( i ):
+		nonlocal resolved
+		waiting[i] -= 1
+		if not waiting[i]:
+			resolved += len(voter_names[i:i+TRUSTEE_BATCH_SIZE])
+			if progress is not None:
+				progress( resolved )
+
+	async def get_hashes( provider ):
+		# replicas share the batches (TRUSTEE_BATCH_CONCURRENCY each), a
+		# batch that fails on one replica is tried on the next ones
+		endpoints = replicas( provider )
+		slots = { endpoint: asyncio.Semaphore( TRUSTEE_BATCH_CONCURRENCY ) for endpoint in endpoints }
+
+		async def get_batch( i ):
+			first = i // TRUSTEE_BATCH_SIZE
+			for k in range(len(endpoints)):
+				host, port = endpoint = endpoints[ (first+k) % len(endpoints) ]
+				async with slots[endpoint]:
+					batch = await trustee_request( stats_dict[endpoint], request_hashes,
+							voter_names[i:i+TRUSTEE_BATCH_SIZE], host, port, timeout = TRUSTEE_BATCH_TIMEOUT, trustee = endpoint )
+				if batch is not None:
+					batch_done( i )
+					return batch
+
+		batches = await asyncio.gather(*[ get_batch( i ) for i in starts ])
+		if None in batches:
+			return None
+		return [ h for batch in batches for h in batch ]
+
+	hashes = await asyncio.gather(*[ get_hashes( provider ) for provider in providers ])
+	if None in hashes:
+		JOURNAL.warning( 'some trustee did not respond with hashes for the voters list' )
+		return None
+	return [ b''.join(h) for h in zip(*hashes) ]
+
 def enc( string ):
     return string.encode( ENCODING )
 
@@ -69,40 +359,155 @@ def byte_length(i):
 def int_as_bytes(i):
 	return i.to_bytes( byte_length(i), 'big' )
 
+class FrameTooLarge(ValueError):
+	"""
+		a frame is longer than the receiver (or sender) accepts ; the stream
+		cannot be resynchronized, the connection should be closed
+	"""
+	pass
+
+def encode_length( l ):
+	"""
+		a frame header : the length in big-endian groups of 7 bits, the MSB
+		being set on the last byte only (so lengths below 128 are a single
+		byte 0x80+l)
+	"""
+	header = [ 0x80 | (l & 0x7f) ]
+	l >>= 7
+	while l:
+		header.append( l & 0x7f )
+		l >>= 7
+	return bytes(reversed(header))
+
+def encode_frame( b, max_len = MAX_FRAME_LEN ):
+	"""
+		returns b with its length header, ready to be written as a single
+		chunk (so concurrent writers cannot interleave a header and a payload)
+	"""
+	if len(b) > max_len:
+		raise FrameTooLarge(f"refusing to send {len(b)} bytes (max. {max_len})")
+	return encode_length(len(b)) + b
+
 async def send_bytes( writer, b ):
-	l = len(b)
-	#print(f"need to send {l} bytes")
-	if l < 128:
-		# number of bytes to send fits on 7 bits
-		bytelen = l+128
-		writer.write(bytelen.to_bytes(1,'big'))
-	else:
-		# number of bytes to send requires more than 7 bits
-		bytelen = byte_length(l)
-		if l < 128:
-			writer.write(bytelen.to_bytes(1,'big'))
-			# the other end of the link now knows it must fetch a large integer of bytelen that is the size of the integer to read
-		else:
-			raise Exception("TODO make this recursive")
-	writer.write(b)
+	writer.write(encode_frame(b))
 	await writer.drain()
 	#print(f"wrote {b}")
-	logging.debug(f"wrote {b}")
-
-async def recv_bytes( reader ):
-	# TODO make this recursive for very large bytestrings ; the MSB should be 1 to stop recursion
-	bytelen = int.from_bytes(await reader.read(1),'big')
-	if bytelen > 128:
-		bytelen -= 128
-		#print(f"reading {bytelen} bytes")
-		data = await reader.read(bytelen)
-	else:
-		#print(f"integer size is {bytelen} bytes")
-		bytelen = int.from_bytes(await reader.read(bytelen),'big')
-		#print(f"reading {bytelen} bytes")
-		data = await reader.read(bytelen)
+	JOURNAL.debug( 'frame sent', data = b )
+
+async def recv_length( reader, max_len = MAX_FRAME_LEN ):
+	"""
+		reads a frame header ; returns None on EOF before the header
+	"""
+	byte = await reader.read(1)
+	if not byte:
+		return None
+	bytelen = 0
+	while True:
+		bytelen = (bytelen << 7) | (byte[0] & 0x7f)
+		if bytelen > max_len:
+			raise FrameTooLarge(f"peer wants to send more than {max_len} bytes")
+		if byte[0] & 0x80:
+			return bytelen
+		byte = await reader.readexactly(1)
+
+async def recv_bytes( reader, max_len = MAX_FRAME_LEN ):
+	"""
+		reads a frame ; EOF before the frame reads as an empty frame, EOF
+		within the frame raises asyncio.IncompleteReadError
+	"""
+	bytelen = await recv_length( reader, max_len )
+	#print(f"reading {bytelen} bytes")
+	data = b'' if bytelen is None else await reader.readexactly(bytelen)
 
 	#print(f"received {data}")
-	logging.debug(f"Data received: {data}")
+	JOURNAL.debug( 'frame received', data = data )
 
 	return data
+
+async def recv_into( reader, buffer, max_len = MAX_FRAME_LEN ):
+	"""
+		reads a frame into `buffer` (a bytearray, re-used from one frame to
+		the next and grown if needed) and returns a memoryview of the payload
+		; no bytes object is built for the frame. the view is only valid until
+		the next call with the same buffer, and must be released before it
+		(the buffer cannot grow while a view on it exists)
+	"""
+	bytelen = await recv_length( reader, max_len )
+	if not bytelen:
+		return memoryview(b'')
+	if len(buffer) < bytelen:
+		buffer.extend( bytes(bytelen - len(buffer)) )
+	view = memoryview(buffer)[:bytelen]
+	n = 0
+	while n < bytelen:
+		chunk = await reader.read(bytelen - n)
+		if not chunk:
+			raise asyncio.IncompleteReadError(bytes(view[:n]), bytelen)
+		view[n:n+len(chunk)] = chunk
+		n += len(chunk)
+	return view
+
+class PollBusy(ConnectionRefusedError):
+	"""
+		the ballot server had no slot for the connection ; retry_after is
+		the delay it suggested, in seconds
+	"""
+	def __init__( self, retry_after ):
+		super().__init__(f"ballot server busy, retry in {retry_after}s")
+		self.retry_after = retry_after
+
+def check_busy( data ):
+	"""
+		raises PollBusy if `data` (a frame received from PORT_POLLING) is a
+		busy frame rather than a verification key
+	"""
+	if data[:1] == POLL_BUSY:
+		raise PollBusy( int.from_bytes(data[1:5],'big')/1000 )
+
+def jittered_backoff( attempt, base = SUBMIT_RETRY_DELAY, cap = SUBMIT_RETRY_MAX ):
+	"""
+		"full jitter" : uniform in [0, base*2**attempt], capped, so clients
+		turned away together do not all come back together
+	"""
+	return random.uniform( 0, min( cap, base * 2**attempt ) )
+
+async def with_retries( attempt, host, port, retries = SUBMIT_RETRIES, errors = (ConnectionRefusedError, ConnectionResetError) ):
+	"""
+		awaits attempt() (a submission to the ballot server at host:port) ;
+		`errors` (busy and refused connections at least : PollBusy is a
+		ConnectionRefusedError) are retried with jittered exponential backoff
+		(at least the delay a busy server asked for) up to `retries` times,
+		then the last error is raised
+	"""
+	for n in range( retries + 1 ):
+		try:
+			return await attempt()
+		except errors as e:
+			if n == retries:
+				raise
+			delay = max( getattr(e, 'retry_after', 0), jittered_backoff( n ) )
+			JOURNAL.info( 'submission retried', host = host, port = port, error = repr(e), delay = delay )
+			await asyncio.sleep( delay )
+
+async def submit_ballot( host, port, voter_id, secret, answer, retries = SUBMIT_RETRIES ):
+	"""
+		sends one (voter ID, SecretID as bytes, answer) submission to a ballot
+		server ; returns the verification key, or None if the vote was not
+		cast. busy, refused and reset connections are retried, see with_retries()
+	"""
+	async def attempt():
+		reader, writer = await asyncio.open_connection( host, port )
+		try:
+			writer.write( encode_frame(voter_id) + encode_frame(secret) + encode_frame(answer) )
+			await writer.drain()
+			data = await recv_bytes( reader )
+		finally:
+			writer.close()
+			try:
+				await writer.wait_closed()
+			except ConnectionError:
+				pass
+		check_busy( data )
+		return int.from_bytes( data, 'big' ) or None
+
+	return await with_retries( attempt, host, port, retries )
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	versioned snapshot of a BallotMiddleMan's public state, in shared memory
+
+	the ballot process publishes (see BallotMiddleMan.publish_stats) and any
+	number of HTTP worker processes read (see dashboard.py), without ever
+	talking to each other : the snapshot is a file (on a tmpfs, preferably)
+	that every process maps.
+
+	layout : sequence number (64 bits), payload length (64 bits), time it
+	was published (wall clock, a double), payload (JSON). the writer
+	publishes regularly, so the time tells whether it is still alive (see
+	age()) ; it removes the file when it closes. the sequence number is a seqlock : the writer makes it odd while
+	it writes and even again when done, a reader retries when it sees an odd
+	number or when it changed while reading. the file only ever grows (and
+	a restarted writer carries on with the sequence numbers) ; a reader
+	whose map is too short for the payload maps it again.
+"""
+import json
+import mmap
+import os
+import struct
+import time
+
+HEADER = struct.Struct( '<QQd' )
+
+class SharedSnapshot:
+	"""
+
+		the writer opens with create = True (one writer only), readers without
+
+	"""
+	def __init__( self, path, create = False, size = 1 << 16 ):
+		self.path = path
+		self.writer = create
+		if create:
+			fd = os.open( path, os.O_RDWR | os.O_CREAT, 0o644 )
+			if os.fstat( fd ).st_size < size:
+				os.ftruncate( fd, size )	# never shrunk : readers may have it mapped
+			os.close( fd )
+		self.mm = None
+		self.map()
+		self.seq = ( HEADER.unpack_from( self.mm )[0] + 1 ) & ~1 if create else 0
+		self.cached = None		# (sequence number, document) last read
+
+	def map( self ):
+		if self.mm is not None:
+			self.mm.close()
+		with open( self.path, 'r+b' if self.writer else 'rb' ) as f:
+			self.mm = mmap.mmap( f.fileno(), 0, access = mmap.ACCESS_WRITE if self.writer else mmap.ACCESS_READ )
+
+	def publish( self, document ):
+		"""
+			writes a new version of the document (anything json.dumps takes)
+		"""
+		payload = json.dumps( document ).encode()
+		if HEADER.size + len(payload) > len(self.mm):
+			with open( self.path, 'r+b' ) as f:
+				os.ftruncate( f.fileno(), 1 << (HEADER.size + len(payload)).bit_length() )
+			self.map()
+		mm = self.mm
+		self.seq += 1
+		HEADER.pack_into( mm, 0, self.seq, 0, 0. )		# odd : being written
+		mm[HEADER.size:HEADER.size+len(payload)] = payload
+		self.seq += 1
+		HEADER.pack_into( mm, 0, self.seq, len(payload), time.time() )
+
+	def read( self ):
+		"""
+			the latest document (None if nothing was published yet) ; it is
+			only parsed again when it changed
+		"""
+		while True:
+			seq, length, _ = HEADER.unpack_from( self.mm )
+			if self.cached is not None and seq == self.cached[0]:
+				return self.cached[1]
+			if not seq:
+				return None
+			if seq & 1:
+				time.sleep( 0 )		# being written
+				continue
+			if HEADER.size + length > len(self.mm):
+				self.map()
+				continue
+			payload = self.mm[HEADER.size:HEADER.size+length]
+			if HEADER.unpack_from( self.mm )[0] != seq:
+				continue
+			self.cached = ( seq, json.loads( payload ) )
+			return self.cached[1]
+
+	def age( self ):
+		"""
+			seconds since the last version was published (None if none was)
+		"""
+		seq, _, published = HEADER.unpack_from( self.mm )
+		return time.time() - published if seq else None
+
+	def close( self ):
+		"""
+			the writer removes the file : readers see it is gone when they
+			open it again
+		"""
+		self.mm.close()
+		if self.writer:
+			try:
+				os.unlink( self.path )
+			except FileNotFoundError:
+				pass
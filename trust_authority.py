@@ -5,9 +5,96 @@
     trust authority instance
 """
 import asyncio
+import functools
 import logging
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from constants import *
-#from shared_funcs import dec, enc
+from shared_funcs import send_bytes, recv_bytes, recv_into, encode_frame, FrameTooLarge
+from journal import JOURNAL
+from hash_table import HashTable
+
+_worker_hashfunc = None		# set in each process of a ProcessPoolExecutor
+
+def _init_worker( hashfunc ):
+	global _worker_hashfunc
+	_worker_hashfunc = hashfunc
+
+def _hash_many( requests, hashfunc = None ):
+	hashfunc = hashfunc or _worker_hashfunc
+	return [ hashfunc( request ) for request in requests ]
+
+class HashExecutor:
+	"""
+
+		runs a hash function in a thread or process pool : requests that
+		queue up while all workers are busy are handed to the next free
+		worker as one batch (up to `batch` of them), so the cost of a round
+		trip to a worker is shared
+
+		a process pool gets the hash function once per worker (it must be
+		picklable, as module-level functions, dicts and HashTables are)
+
+	"""
+	def __init__( self, hashfunc, kind = 'thread', workers = None, batch = TRUSTEE_EXECUTOR_BATCH ):
+		self.workers = workers or os.cpu_count()
+		self.batch = batch
+		if kind == 'process':
+			self.pool = ProcessPoolExecutor( self.workers, initializer = _init_worker, initargs = (hashfunc,) )
+			self.call = _hash_many
+		elif kind == 'thread':
+			self.pool = ThreadPoolExecutor( self.workers, thread_name_prefix = 'hash' )
+			self.call = functools.partial( _hash_many, hashfunc = hashfunc )
+		else:
+			raise ValueError(f"unknown executor {kind!r} (expecting 'thread' or 'process')")
+		self.queue = deque()		# (request, future)
+		self.busy = 0				# batches being hashed
+		self.scheduled = False
+
+	def submit( self, request ):
+		"""
+			returns an asyncio future for the hash of request
+		"""
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self.queue.append(( request, future ))
+		if not self.scheduled:
+			# requests arriving in the same iteration of the loop can share a batch
+			self.scheduled = True
+			loop.call_soon( self.dispatch )
+		return future
+
+	def dispatch( self ):
+		self.scheduled = False
+		loop = asyncio.get_running_loop()
+		while self.queue and self.busy < self.workers:
+			# share what is queued among the idle workers
+			size = min( self.batch, -( -len(self.queue) // (self.workers-self.busy) ) )
+			batch = [ self.queue.popleft() for _ in range(size) ]
+			self.busy += 1
+			loop.run_in_executor( self.pool, self.call, [ request for request, _ in batch ] ).add_done_callback(
+					functools.partial( self.done, batch ) )
+
+	def done( self, batch, result ):
+		self.busy -= 1
+		try:
+			hashes = result.result()
+		except Exception as e:
+			for _, future in batch:
+				if not future.done():
+					future.set_exception( e )
+		else:
+			for (_, future), h in zip(batch, hashes):
+				if not future.done():
+					future.set_result( h )
+		if self.queue:
+			self.dispatch()
+
+	def shutdown( self ):
+		self.pool.shutdown( cancel_futures = True )
 
 class TrustAuthority:
 	"""
@@ -23,20 +110,27 @@ class TrustAuthority:
 
 		this ensures a high level of anonymity and high security
 	"""
-	def __init__( self, seq_id, name, hash, desc = None ):
+	def __init__( self, seq_id, name, hash, desc = None, executor = None, pool_size = None ):
+		"""
+			executor is None (hash on the event loop, fine for cheap
+			functions), 'thread' or 'process' (for a deliberately slow KDF ;
+			see HashExecutor) ; pool_size defaults to the number of CPUs
+		"""
 		self.seq_id = seq_id
 		self.name = name
 		if desc: self.desc = desc
 
 		if callable(hash):
 			self.hashfunc = hash
-		elif type(hash) is dict:
+		elif type(hash) is dict or isinstance(hash, HashTable):	# see hash_table.py for large rolls
 			self.hashfunc = hash.get
 		else:
 			raise Exception("`hash` value invalid")
+		self.executor = None if executor is None else HashExecutor( self.hashfunc, executor, pool_size )
+		self.hashes = 0				# requests served, see serve_workers()
 
-	async def run( self, host, port ):
-		server = await asyncio.start_server(self.trustee_callback, host, port)
+	async def run( self, host, port, reuse_port = False ):
+		server = await asyncio.start_server(self.trustee_callback, host, port, reuse_port = reuse_port)
 		address = ', '.join(str(sock.getsockname()) for sock in server.sockets)
 		print(f"{self.name}: listening on {address}")
 		logging.info(f"{self.name}: listening on {address}")
@@ -51,7 +145,18 @@ class TrustAuthority:
 		:param writer: Writer stream
 
 		"""
-		request = await reader.read(MAX_MESSAGE_LEN)
+		request = await reader.read(1)
+		if request == TRUSTEE_BATCH:
+			return await self.batch_callback( reader, writer )
+		elif request == TRUSTEE_MUX:
+			return await self.mux_callback( reader, writer )
+		# single request : the voter ID is everything up to EOF
+		while ( chunk := await reader.read(MAX_FRAME_LEN) ):
+			request += chunk
+			if len(request) > MAX_FRAME_LEN:
+				JOURNAL.warning( 'request too long', max_len = MAX_FRAME_LEN )
+				writer.close()
+				return await writer.wait_closed()
 	
 		# TODO, show client information in debug log :
 		# 15:41 < petaflot> hello! I was wondering.. if I have sth like
@@ -65,24 +170,25 @@ class TrustAuthority:
 		# you access to the host information at least.
 
 		#print(f"received: {request}")
-		logging.debug(f"received: {request}")
+		JOURNAL.debug( 'request', voter = request )
 
 		# if client is BallotMiddleMan (known thanks to authenticated communication channel TODO):
 		# TODO open return chanel and echo request
 
 		# TODO response must be tailored to each BallotMiddleMan server instance, so it cannot be used on other instances with the same question in a sort of replay attack
-		return_message = self.hashfunc( request )
+		return_message = self.hashfunc( request ) if self.executor is None else await self.executor.submit( request )
+		self.hashes += 1
 	
 		# if client is BallotMiddleMan (known thanks to authenticated communication channel TODO):
 		# TODO close connection now and send reponse through polling port (with slightly improved protocol)
 
 		# Send response
 		if return_message is not None:
-			print(f"Send for voterID {request}: hash{self.seq_id} = {return_message}")
+			JOURNAL.info( 'hash sent', voter = request, trustee = self.seq_id, hash = return_message )
 			#logging.debug(f"Send: {return_message}")
 			writer.write(return_message)
 		else:
-			print(f"WARNING: Nothing to send!")
+			JOURNAL.warning( 'nothing to send', voter = request )
 			#logging.debug(f"Nothing to send")
 
 	
@@ -92,15 +198,195 @@ class TrustAuthority:
 		writer.close()
 		await writer.wait_closed()
 
+	async def batch_callback(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		"""
+
+			batch mode (the connection started with TRUSTEE_BATCH) : framed
+			voter IDs come in until an empty frame (or EOF), a framed hash is
+			sent back for each of them, in order ; unknown voters get an empty
+			frame
+
+			with an executor, voter IDs keep being read (and queued for the
+			workers) while earlier hashes are being computed
+
+		"""
+		n = 0
+		pending = asyncio.Queue( TRUSTEE_BATCH_SIZE )	# futures, in order
+
+		async def receive():
+			while ( request := await recv_bytes( reader ) ):
+				await pending.put( self.executor.submit( request ) )
+			await pending.put( None )
+
+		async def send():
+			nonlocal n
+			while ( future := await pending.get() ) is not None:
+				return_message = await future
+				await send_bytes( writer, b'' if return_message is None else return_message )
+				n += 1
+
+		tasks = []
+		try:
+			if self.executor is None:
+				while ( request := await recv_bytes( reader ) ):
+					return_message = self.hashfunc( request )
+					await send_bytes( writer, b'' if return_message is None else return_message )
+					n += 1
+			else:
+				tasks = [ asyncio.create_task( receive() ), asyncio.create_task( send() ) ]
+				await asyncio.gather(*tasks)
+		except (ConnectionError, asyncio.IncompleteReadError, FrameTooLarge) as e:
+			JOURNAL.warning( 'batch aborted', error = repr(e) )
+		finally:
+			for task in tasks:
+				task.cancel()
+			self.hashes += n
+			JOURNAL.info( 'batch sent', trustee = self.seq_id, hashes = n )
+			writer.close()
+			await writer.wait_closed()
+
+	async def mux_callback(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		"""
+
+			multiplexed mode (the connection started with TRUSTEE_MUX) : a
+			long-lived connection carrying (request ID, voter ID) frame pairs
+			; each gets a (request ID, hash) pair back. an empty voter ID is a
+			ping and gets an empty answer. see trustee_pool.py
+
+			with an executor, answers are sent as soon as they are ready,
+			not necessarily in order
+
+		"""
+		buffer = bytearray(8)		# request IDs are echoed back, no need for a bytes object
+		try:
+			while ( req_id := await recv_into( reader, buffer ) ):
+				request = await recv_bytes( reader )
+				self.hashes += bool(request)
+				if request and self.executor is not None:
+					self.executor.submit( request ).add_done_callback( functools.partial( self.mux_reply, writer, bytes(req_id) ) )
+				else:
+					return_message = self.hashfunc( request ) if request else b''
+					writer.write( encode_frame(req_id) + encode_frame(b'' if return_message is None else return_message) )
+				req_id.release()
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError, FrameTooLarge):
+			pass
+		finally:
+			writer.close()
+			await writer.wait_closed()
+
+	@staticmethod
+	def mux_reply( writer, req_id, future ):
+		if future.cancelled() or writer.is_closing():
+			return
+		if future.exception() is not None:
+			JOURNAL.error( 'hash failed', error = repr(future.exception()) )
+			return_message = None
+		else:
+			return_message = future.result()
+		writer.write( encode_frame(req_id) + encode_frame(b'' if return_message is None else return_message) )
+
+
+def use_uvloop():
+	"""
+		uvloop is optional ; returns whether it is used
+	"""
+	try:
+		import uvloop
+	except ImportError:
+		print("WARNING: uvloop is not installed, using the default event loop")
+		return False
+	asyncio.set_event_loop_policy( uvloop.EventLoopPolicy() )
+	return True
+
+def serve_worker( n, TA, host, port, counters, uvloop = False, executor = None, pool_size = None ):
+	"""
+		worker process of serve_workers() : serves on the shared port and
+		publishes how many requests it served in counters[n] ; the worker's
+		own HashExecutor is built here, after the fork. SIGTERM stops it
+		(and its executor)
+	"""
+	async def publish():
+		while True:
+			counters[n] = TA.hashes
+			await asyncio.sleep(1)
+
+	async def main():
+		asyncio.get_running_loop().add_signal_handler( signal.SIGTERM, asyncio.current_task().cancel )
+		asyncio.create_task( publish() )
+		await TA.run( host, port, reuse_port = True )
+
+	if uvloop:
+		use_uvloop()
+	if executor is not None:
+		TA.executor = HashExecutor( TA.hashfunc, executor, pool_size )
+	try:
+		asyncio.run( main() )
+	except (KeyboardInterrupt, asyncio.CancelledError):
+		pass
+	finally:
+		if TA.executor is not None:
+			TA.executor.shutdown()
+
+def serve_workers( TA, host, port, workers, uvloop = False, executor = None, pool_size = None ):
+	"""
+		forks `workers` processes sharing the listening port (SO_REUSEPORT :
+		the kernel spreads the connections among them) ; a trustee's answer
+		only depends on the request, so they need not share anything else
+
+		TA must not have an executor : a pool (its queues, threads or
+		processes) cannot be shared across a fork. `executor` and
+		`pool_size` (see TrustAuthority) give each worker a pool of its own
+
+		the parent restarts workers that die and reports the requests served
+		by all of them every TRUSTEE_STATS_INTERVAL seconds ; it stops them
+		when it is interrupted
+	"""
+	if TA.executor is not None:
+		raise ValueError("the executor must be built in the workers, see serve_workers( executor = ... )")
+	if executor not in ( None, 'thread', 'process' ):
+		raise ValueError(f"unknown executor {executor!r} (expecting 'thread' or 'process')")	# rather than in every worker
+	import multiprocessing
+	context = multiprocessing.get_context('fork')	# the workers inherit TA as it is
+	counters = context.Array( 'Q', workers, lock = False )	# one writer per slot
+	processes = [ None ] * workers
+	served = 0
+	try:
+		while True:
+			for n, p in enumerate(processes):
+				if p is None or not p.is_alive():
+					if p is not None:
+						JOURNAL.warning( 'worker died', worker = n, exitcode = p.exitcode )
+					# not daemonic : a worker may have the processes of its executor
+					processes[n] = context.Process( target = serve_worker, args = ( n, TA, host, port, counters, uvloop, executor, pool_size ) )
+					processes[n].start()
+			time.sleep( TRUSTEE_STATS_INTERVAL )
+			total = sum(counters)
+			JOURNAL.info( 'workers', trustee = TA.seq_id, alive = sum( p.is_alive() for p in processes ),
+					hashes = total, rate = f"{(total-served)/TRUSTEE_STATS_INTERVAL:.1f}/s", per_worker = list(counters) )
+			served = total
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for p in processes:
+			if p is not None:
+				p.terminate()
+		for p in processes:
+			if p is not None:
+				p.join( TRUSTEE_WORKER_STOP )
+				if p.is_alive():
+					p.kill()
+					p.join()
 
 if __name__ == '__main__':
-	from sys import argv
+	import argparse
 	import importlib
-	try:
-		trustee_id = int(argv[1])
-	except IndexError:
-		print(f"usage: {argv[0]} <trustee_id>")
-		raise SystemExit
+	parser = argparse.ArgumentParser( description = "trust authority" )
+	parser.add_argument( 'trustee_id', type = int, help = "serves sample_configs/trustee_<trustee_id>.py" )
+	parser.add_argument( '--workers', type = int, default = 1, help = "processes sharing the port (SO_REUSEPORT)" )
+	parser.add_argument( '--uvloop', action = 'store_true', help = "use uvloop (if installed)" )
+	args = parser.parse_args()
+	trustee_id = args.trustee_id
 
 	conf = importlib.import_module(f"sample_configs.trustee_{trustee_id}")
 
@@ -121,5 +407,13 @@ provide a proof of their identity such as:
 Once the voter has been identified, provide them with their hash and off they go.
 """)
 
-	TA = TrustAuthority( trustee_id, conf.conf.pop('name'), conf.hash, conf.conf.pop('desc',None) )
-	asyncio.run( TA.run( *conf.conf.pop('serve') ) )
+	executor, pool_size = conf.conf.pop('executor',None), conf.conf.pop('pool_size',None)
+	if args.workers > 1:
+		# each worker builds its executor, see serve_workers()
+		TA = TrustAuthority( trustee_id, conf.conf.pop('name'), conf.hash, conf.conf.pop('desc',None) )
+		serve_workers( TA, *conf.conf.pop('serve'), args.workers, args.uvloop, executor, pool_size )
+	else:
+		TA = TrustAuthority( trustee_id, conf.conf.pop('name'), conf.hash, conf.conf.pop('desc',None), executor, pool_size )
+		if args.uvloop:
+			use_uvloop()
+		asyncio.run( TA.run( *conf.conf.pop('serve') ) )
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	long-lived, multiplexed connections to the trust authorities
+
+	instead of one TCP connection per hash lookup, a TrusteePool keeps
+	TRUSTEE_POOL_SIZE connections open to each trustee (host, port) ; every
+	lookup gets a request ID so many of them can be outstanding on the same
+	socket at once, and answers may come back in any order.
+
+	connections are pinged every TRUSTEE_PING_INTERVAL seconds and dropped when
+	they do not answer ; a dropped connection fails its outstanding lookups
+	(so trustee_request() retries them) and is re-opened on next use.
+"""
+import asyncio
+
+from shared_funcs import recv_bytes, encode_frame, int_as_bytes, increment, replicas, trustee_label
+from journal import JOURNAL
+from constants import TRUSTEE_MUX, TRUSTEE_POOL_SIZE, TRUSTEE_PING_INTERVAL, TRUSTEE_TIMEOUT
+
+class TrusteeConnection:
+	"""
+
+		one multiplexed connection to a trust authority
+
+	"""
+	def __init__( self, host, port, stats ):
+		self.host = host
+		self.port = port
+		self.stats = stats			# the STATS entry of this trustee
+		self.pending = {}			# request ID -> future
+		self.next_id = 1			# request ID 0 would be an empty frame, ie. EOF
+		self.writer = None
+		self.lock = asyncio.Lock()
+		self.health = None
+
+	@property
+	def connected( self ):
+		return self.writer is not None and not self.writer.is_closing()
+
+	async def connect( self ):
+		async with self.lock:
+			if self.connected:
+				return
+			reader, writer = await asyncio.open_connection( self.host, self.port )
+			writer.write( TRUSTEE_MUX )
+			self.writer = writer
+			self.pending = {}		# lookups outstanding on this very socket
+			asyncio.create_task( self.receive( reader, writer, self.pending ) )
+			if self.health is None:
+				self.health = asyncio.create_task( self.health_check() )
+
+	async def receive( self, reader, writer, pending ):
+		"""
+			dispatches answers to the waiting lookups until the connection
+			drops, then fails whatever is still outstanding on it
+		"""
+		try:
+			while ( req_id := await recv_bytes( reader ) ):
+				data = await recv_bytes( reader )
+				try:
+					pending[int.from_bytes(req_id,'big')].set_result( data )
+				except (KeyError, asyncio.InvalidStateError):
+					pass	# lookup timed out or was cancelled in the meantime
+		except (OSError, asyncio.IncompleteReadError) as e:
+			increment( self.stats, type(e) )
+		finally:
+			if self.writer is writer:
+				self.writer = None
+			writer.close()
+			for fut in pending.values():
+				if not fut.done():
+					fut.set_exception( ConnectionResetError(f"connection to {(self.host,self.port)} lost") )
+
+	async def request( self, voter_name ):
+		await self.connect()
+		writer, pending = self.writer, self.pending
+		if writer is None:
+			raise ConnectionResetError(f"connection to {(self.host,self.port)} lost")
+		req_id = self.next_id
+		self.next_id += 1
+		fut = asyncio.get_running_loop().create_future()
+		pending[req_id] = fut
+		try:
+			# a single write, so concurrent lookups cannot interleave their frames
+			writer.write( encode_frame(int_as_bytes(req_id)) + encode_frame(voter_name) )
+			await writer.drain()
+			return await fut
+		finally:
+			del pending[req_id]
+
+	async def health_check( self ):
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep( TRUSTEE_PING_INTERVAL )
+			start = loop.time()
+			try:
+				# an empty voter ID is a ping
+				await asyncio.wait_for( self.request( b'' ), TRUSTEE_TIMEOUT )
+			except (OSError, asyncio.TimeoutError) as e:
+				JOURNAL.warning( 'trustee failed health check', trustee = trustee_label( self.host, self.port ), error = repr(e) )
+				increment( self.stats, 'ping failed' )
+				if self.writer is not None:
+					self.writer.close()		# receive() fails the pending lookups
+			else:
+				self.stats['ping'] = loop.time() - start
+
+	def close( self ):
+		if self.health is not None:
+			self.health.cancel()
+			self.health = None
+		if self.writer is not None:
+			self.writer.close()
+
+
+class TrusteePool:
+	"""
+
+		TRUSTEE_POOL_SIZE TrusteeConnection per trustee (host, port) ;
+		get_hash() has the same signature as the per-connection lookup in
+		voter_full_id() so either can be handed to trustee_request()
+
+	"""
+	def __init__( self, stats_dict, size = TRUSTEE_POOL_SIZE ):
+		self.stats_dict = stats_dict
+		self.size = size
+		self.connections = {}
+
+	def connection( self, host, port ):
+		"""
+			the least busy connection to (host, port)
+		"""
+		try:
+			conns = self.connections[(host,port)]
+		except KeyError:
+			conns = self.connections[(host,port)] = [
+					TrusteeConnection( host, port, self.stats_dict[(host,port)] ) for _ in range(self.size) ]
+		return min( conns, key = lambda c: len(c.pending) )
+
+	async def get_hash( self, voter_name, host, port ):
+		return await self.connection( host, port ).request( voter_name )
+
+	async def connect( self, providers ):
+		"""
+			opens the connections to all providers beforehand (optional)
+		"""
+		for provider in providers:
+			for host, port in replicas( provider ):
+				self.connection( host, port )
+		await asyncio.gather(*[ c.connect() for conns in self.connections.values() for c in conns ], return_exceptions = True )
+
+	def close( self ):
+		for conns in self.connections.values():
+			for c in conns:
+				c.close()
+		self.connections = {}
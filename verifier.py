@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	verification replicas for a closed poll
+
+	when the poll closes, BallotMiddleMan.close_poll() publishes the frozen
+	results to VERIFY_SNAPSHOT (see ballot_store.FrozenBallot.save) ; from
+	then on, voters checking their ballot and observers running the
+	statistical audit need nothing else. this app serves them from that
+	file, mmap'd read-only, so any number of worker processes share the
+	same pages :
+
+		./verifier.py [--workers N] [--bind host:port] [--poll-port PORT]
+
+	or with hypercorn itself : hypercorn --workers N 'verifier:serve(PORT)'
+	(verifier:app for PORT_POLLING)
+
+	the snapshot is looked at (stat) on every request : when a new poll
+	starts on the same port it is removed, and when that poll closes it
+	is replaced, so the workers serve the results of the latest closed
+	poll only
+
+	- POST /verify		same as on the ballot server (the probe quota is per worker)
+	- /results.json		{base64 answer: votes}
+	- /health			poll ID, votes and slots of the snapshot ; 503 until it is published
+"""
+import asyncio
+import base64
+import json
+import math
+import os
+import sys
+from array import array
+
+from quart import Quart, request
+
+from shared_funcs import dec, RateLimiter
+from ballot_store import FrozenBallot
+from constants import LISTEN, PORT_POLLING, VERIFY_SNAPSHOT, PORT_VERIFY, VERIFY_WORKERS, VERIFY_MAX_PROBES, VERIFY_CHUNK, PROBE_RATE, PROBE_BURST
+
+app = Quart(__name__)
+app.probe_quota = RateLimiter( PROBE_RATE, PROBE_BURST )
+app.snapshot = VERIFY_SNAPSHOT.format( port = PORT_POLLING )
+app.ballot = None
+app.version = None		# (inode, mtime) of the snapshot app.ballot was loaded from
+
+def serve( poll_port ):
+	"""
+		the app, for the ballot server polling on `poll_port`
+	"""
+	app.snapshot = VERIFY_SNAPSHOT.format( port = poll_port )
+	return app
+
+async def verify_request( verify_votes, quota ):
+	"""
+		batch verification for observers : the body is a sequence of
+		(secret, index) probes, each a pair of 8-byte big-endian unsigned
+		integers ; the answer lists the hits as [position, base64 answer]
+
+		probes count against a per-client quota (PROBE_RATE per second) and
+		are verified VERIFY_CHUNK at a time so other requests keep flowing
+	"""
+	data = await request.get_data()
+	if len(data) % 16 or len(data) > 16*VERIFY_MAX_PROBES:
+		return f"expecting up to {VERIFY_MAX_PROBES} pairs of 8-byte big-endian integers", 400
+	n = len(data) // 16
+	wait = quota.take( request.remote_addr, n )
+	if wait:
+		return "probe quota exceeded", 429, {"Retry-After": str(math.ceil(wait))}
+
+	probes = array('Q', data)
+	if sys.byteorder == 'little':
+		probes.byteswap()
+	secrets, indexes = probes[0::2], probes[1::2]
+	hits = []
+	for i in range(0, n, VERIFY_CHUNK):
+		hits += [ [i+p, dec(base64.b64encode(answer))] for p, answer in verify_votes( secrets[i:i+VERIFY_CHUNK], indexes[i:i+VERIFY_CHUNK] ) ]
+		await asyncio.sleep(0)
+	return json.dumps({ "probes": n, "hits": hits })
+
+def ballot():
+	"""
+		the snapshot, loaded again when it was replaced ; None while the
+		poll is open
+	"""
+	try:
+		st = os.stat( app.snapshot )
+	except FileNotFoundError:
+		app.ballot = app.version = None
+		return None
+	# save() renames a new file into place : another inode
+	if ( st.st_ino, st.st_mtime_ns ) != app.version:
+		try:
+			app.ballot = FrozenBallot.load( app.snapshot )
+		except FileNotFoundError:
+			app.ballot = app.version = None
+			return None
+		app.version = ( st.st_ino, st.st_mtime_ns )
+	return app.ballot
+
+NOT_CLOSED = "the poll is not closed yet", 503, {"Retry-After": "60"}
+
+@app.route("/verify", methods=["POST"])
+async def verify_api():
+	if ( b := ballot() ) is None:
+		return NOT_CLOSED
+	return await verify_request( b.verify_many, app.probe_quota )
+
+@app.route("/results.json")
+async def results_api():
+	if ( b := ballot() ) is None:
+		return NOT_CLOSED
+	return json.dumps({ dec(base64.b64encode(answer)): votes for answer, votes in b.tally.items() })
+
+@app.route("/health")
+async def health_api():
+	if ( b := ballot() ) is None:
+		return NOT_CLOSED
+	return json.dumps({ 'poll': b.poll, 'votes': b.votes, 'slots': len(b) }), 200, {"Content-Type": "application/json"}
+
+if __name__ == '__main__':
+	import argparse
+	from hypercorn.config import Config
+	from hypercorn.run import run
+	parser = argparse.ArgumentParser( description = "verification replicas for a closed poll" )
+	parser.add_argument( '--workers', type = int, default = VERIFY_WORKERS, help = "processes serving the snapshot" )
+	parser.add_argument( '--bind', default = f"{LISTEN}:{PORT_VERIFY}" )
+	parser.add_argument( '--poll-port', type = int, default = PORT_POLLING, help = "polling port of the ballot server" )
+	args = parser.parse_args()
+
+	config = Config()
+	config.application_path = f'verifier:serve({args.poll_port})'
+	config.bind = [ args.bind ]
+	config.workers = args.workers
+	raise SystemExit( run( config ) )
@@ -5,14 +5,53 @@
 import asyncio
 import logging
 import urllib.request
+import urllib.error
 import base64
+import gzip
 import json
 from datetime import datetime
 
-from shared_funcs import enc, dec, recv_bytes, send_bytes, voter_full_id
+from shared_funcs import enc, dec, voter_full_id, replicas, submit_ballot
 from constants import PORT_HTTP, LISTEN
+from trustee_pool import TrusteePool
 
 STATS = {}
+HTTP_CACHE = {}		# url -> (ETag, decoded document)
+
+def fetch_json( url ):
+	"""
+		a JSON document of a ballot server, decoded (base64 keys and values
+		too) ; fetched again only if it changed since the last time (the
+		server answers 304 to a matching If-None-Match), gzip'd if possible
+	"""
+	req = urllib.request.Request( url, headers = {'Accept-Encoding': 'gzip'} )
+	try:
+		etag, document = HTTP_CACHE[url]
+		req.add_header( 'If-None-Match', etag )
+	except KeyError:
+		pass
+	try:
+		with urllib.request.urlopen( req ) as response:
+			data = response.read()
+			if response.headers.get('Content-Encoding') == 'gzip':
+				data = gzip.decompress( data )
+			etag = response.headers.get('ETag')
+	except urllib.error.HTTPError as e:
+		if e.code == 304:
+			return document
+		raise
+	# parsed once, not once per key
+	document = { base64.b64decode(enc(key)): base64.b64decode(enc(val)) for key, val in json.loads(data).items() }
+	if etag is not None:
+		HTTP_CACHE[url] = ( etag, document )
+	return document
+
+def parse_replicas( line ):
+	"""
+		host:port, or comma-separated host:port of the replicas of a trustee
+	"""
+	hps = [ (HP[0], int(HP[1])) for HP in [hp.split(':',1) for hp in line.split(',')] ]
+	return hps[0] if len(hps) == 1 else tuple(hps)
 
 class Voter:
 	"""
@@ -24,6 +63,7 @@ class Voter:
 	def __init__(self, voter_id):
 		self.voter_id = voter_id
 		self.ballots = {}
+		self.trustee_pool = TrusteePool( STATS )	# shared by all ballots
 
 	async def register_ballot( self, host_port = None ):
 		"""
@@ -44,12 +84,11 @@ class Voter:
 
 		# TODO allow connection over SSL
 		#print('http://'+':'.join([ballot_server_addr, str(ballot_server_port)])+'/config.json')
-		data = urllib.request.urlopen('http://'+':'.join([ballot_server_addr, str(ballot_server_port)])+'/config.json').read()
+		base_url = 'http://'+':'.join([ballot_server_addr, str(ballot_server_port)])
 		ballot_config = {}
 
 		# TODO write a function that does this a bit more automatically and re-usable for other projects
-		for key in json.loads(data):
-			key, val = base64.b64decode(enc(key)), base64.b64decode(enc(json.loads(data)[key]))
+		for key, val in fetch_json( base_url+'/config.json' ).items():
 			match key:
 				case b'poll_port':
 					val = int.from_bytes( val, 'big' )
@@ -62,16 +101,13 @@ class Voter:
 				case b'anticipated_results':
 					val = bool(val)
 				case b'trustees':
-					val = [(HP[0], int(HP[1])) for HP in [hp.split(':',1) for hp in dec(val).split('\n')]]
+					val = [ parse_replicas(line) for line in dec(val).split('\n') ]
 			ballot_config[key] = val
 
-		data = urllib.request.urlopen('http://'+':'.join([ballot_server_addr, str(ballot_server_port)])+'/trustees.json').read()
-		#print(f"{data = }")
-		for key in json.loads(data):
-			key, val = base64.b64decode(enc(key)), base64.b64decode(enc(json.loads(data)[key]))
+		for key, val in fetch_json( base_url+'/trustees.json' ).items():
 			match key:
 				case b'trustees':
-					val = [(HP[0], int(HP[1])) for HP in [hp.split(':',1) for hp in dec(val).split('\n')]]
+					val = [ parse_replicas(line) for line in dec(val).split('\n') ]
 					#print(f"{val = }")
 				case _:
 					print(f"WARNING: trustees data contains unknown key {key}")
@@ -132,48 +168,40 @@ class Voter:
 			trustees = self.ballots[question][ballotter][b'trustees']
 			for t in trustees:
 				# TODO reset the stats from time to time
-				try:				STATS[t]
-				except KeyError:	STATS[t] = {}
+				for hp in replicas(t):
+					try:				STATS[hp]
+					except KeyError:	STATS[hp] = {}
 
 			#print(f"{list(trustees.keys()) = }")
 			port = self.ballots[question][ballotter][b'poll_port']
-			voter_id = await voter_full_id( self.voter_id, trustees, STATS, (ballotter,port) )
+			voter_id = await voter_full_id( self.voter_id, trustees, STATS, (ballotter,port), self.trustee_pool )
 			answer = get_answer( question ) if answer is None else answer
 			#print(self.ballots[question][ballotter].keys())
 			secretID = self.ballots[question][ballotter][b'secret_id']
 			print(f"will submit {answer} to {ballotter[0]}:{port} as {voter_id} with SecretID {hex(int.from_bytes(secretID,'big'))}")
 			try:
-				reader, writer = await asyncio.open_connection(ballotter[0], port)
-				try:
-					for value in (voter_id, secretID, answer):
-						await send_bytes( writer, value )
-					print("all values sent, waiting for confirmation ID")
-
-					verification_key = int.from_bytes(await recv_bytes(reader),'big')	# verification ID as per poc.py
-					if not verification_key:
-						print("""ERROR: vote could could not be cast ; possible causes include :
+				# busy or refused connections are retried (with backoff) by submit_ballot()
+				verification_key = await submit_ballot( ballotter[0], port, voter_id, secretID, answer )	# verification ID as per poc.py
+			except ConnectionError as e:
+				print(f"{e!r}, try again later")
+				return False
+			if not verification_key:
+				print("""ERROR: vote could could not be cast ; possible causes include :
 	- your vote was already recorded
 	- there was a TrustAuthority problem ; try again later (and report the issue if this persists)""")
-						return False
-					else:
-						print(f'Verification key received from {(ballotter[0],port)}: {hex(verification_key)}')
-						logging.debug(f'Verification key received from {(ballotter[0],port)}: {hex(verification_key)}')
-						self.ballots[question][ballotter]['verification_key'] = verification_key
-						return verification_key
-				except:
-					raise
-				finally:
-					writer.close()
-					await writer.wait_closed()
-			
-			except ConnectionRefusedError:
-				print("ConnectionRefusedError, try again later")	# TODO automatic retries
+				return False
+			else:
+				print(f'Verification key received from {(ballotter[0],port)}: {hex(verification_key)}')
+				logging.debug(f'Verification key received from {(ballotter[0],port)}: {hex(verification_key)}')
+				self.ballots[question][ballotter]['verification_key'] = verification_key
+				return verification_key
 
 async def main( voter_id ):
 	V = Voter( voter_id )
 	# TODO prompt for or read from args/ncofig/whatever
 	await V.register_ballot( (LISTEN, PORT_HTTP) )
 	await V.submit_vote()
+	V.trustee_pool.close()
 
 if __name__ == '__main__':
 	from sys import argv
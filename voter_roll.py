@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# vim: ts=4 noet number nowrap
+"""
+	the public voters list, served at /voters/
+
+	the roll is public by design (peers cross-check it), and may have
+	millions of entries : it is cut into pages of ROLL_CHUNK voters once,
+	when it is loaded, each page serialized as text (one voter ID per line)
+	and JSON (an array of base64 voter IDs), and gzip'd. serving a page or
+	the whole roll then only copies bytes that are ready.
+
+	- /voters/?format=text|json&cursor=N	one page ; the cursor of the next
+										one is in the Link and X-Next-Cursor
+										headers (absent on the last page)
+	- /voters/?format=text|json&stream=1	the whole roll, page after page
+										(gzip'd too : gzip members can be
+										concatenated)
+"""
+import asyncio
+import base64
+import gzip
+from hashlib import blake2b
+
+from http_cache import CachedDocument, accepts_gzip
+from constants import ROLL_CHUNK, ROLL_COMPRESSLEVEL
+
+CONTENT_TYPES = { 'text': 'text/plain; charset=utf-8', 'json': 'application/json' }
+
+def compress( data ):
+	return gzip.compress( data, ROLL_COMPRESSLEVEL, mtime = 0 )
+
+class VoterRoll:
+	"""
+
+		the pages of `voters` (a sequence of voter IDs) ; takes a few
+		seconds per million voters, better built in a thread
+
+	"""
+	def __init__( self, voters, chunk = ROLL_CHUNK ):
+		self.count = len(voters)
+		self.pages = { fmt: [] for fmt in CONTENT_TYPES }
+		# the whole roll as a stream : (plain, gzip'd) parts
+		self.parts = { fmt: [] for fmt in CONTENT_TYPES }
+		self.parts['json'].append(( b'[', compress(b'[') ))
+		roll_hash = blake2b( digest_size = 16 )
+		n = max( 1, -(-len(voters) // chunk) )
+		for i in range(n):
+			voters_page = voters[i*chunk:(i+1)*chunk]
+			text = b''.join([ v + b'\n' for v in voters_page ])
+			items = b','.join([ b'"' + base64.b64encode(v) + b'"' for v in voters_page ])
+			roll_hash.update( text )
+			fragment = ( b',' if i else b'' ) + items
+			self.parts['json'].append(( fragment, compress(fragment) ))
+			for fmt, body in (( 'text', text ), ( 'json', b'[' + items + b']' )):
+				headers = {}
+				if i+1 < n:
+					headers['Link'] = f'</voters/?format={fmt}&cursor={i+1}>; rel="next"'
+					headers['X-Next-Cursor'] = str(i+1)
+				page = CachedDocument( body, content_type = CONTENT_TYPES[fmt], gzipped = compress(body), headers = headers )
+				self.pages[fmt].append( page )
+			# the text pages are the stream's gzip members as they are
+			self.parts['text'].append(( text, self.pages['text'][-1].gzipped or compress(text) ))
+		self.parts['json'].append(( b']', compress(b']') ))
+		digest = roll_hash.hexdigest()
+		self.etags = { fmt: f'"{digest}-{fmt}"' for fmt in CONTENT_TYPES }
+
+	def page( self, fmt, cursor ):
+		"""
+			the CachedDocument of a page ; KeyError for an unknown format or cursor
+		"""
+		try:
+			cursor = int(cursor)
+			if cursor < 0:
+				raise ValueError
+			return self.pages[fmt][cursor]
+		except (ValueError, IndexError):
+			raise KeyError( cursor )
+
+	def stream( self, fmt, request ):
+		"""
+			the response to `request` (a Quart request) for the whole roll,
+			as (body, status, headers) ; the body is an async generator
+		"""
+		etag = self.etags[fmt]
+		headers = { 'Content-Type': CONTENT_TYPES[fmt], 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding', 'X-Voters': str(self.count) }
+		zipped = accepts_gzip( request.headers.get('Accept-Encoding', '') )
+		if zipped:
+			etag = etag[:-1] + '-gzip"'
+			headers['Content-Encoding'] = 'gzip'
+		headers['ETag'] = etag
+		if etag in [ t.strip() for t in request.headers.get('If-None-Match', '').split(',') ]:
+			return b'', 304, headers
+		parts = self.parts[fmt]
+
+		async def body():
+			for part in parts:
+				yield part[zipped]
+				await asyncio.sleep(0)	# one page at a time, whatever the client's speed
+
+		return body(), 200, headers